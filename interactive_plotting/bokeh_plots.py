@@ -20,7 +20,8 @@ import matplotlib
 import bokeh
 
 
-from interactive_plotting.utils._utils import sample_unif, sample_density, to_hex_palette
+from interactive_plotting.utils._utils import sample_unif, sample_density, to_hex_palette, gene_vector, expression_accessor, \
+    hex_palette, palette_lut, fingerprint, LRUCache, diffusion_pseudotime, PALETTE_SIZE
 from bokeh.plotting import figure, show, save as bokeh_save
 from bokeh.models import ColumnDataSource, Slider, HoverTool, ColorBar, \
         Patches, Legend, CustomJS, TextInput, LabelSet, Select 
@@ -102,7 +103,10 @@ def _set_plot_wh(fig, w, h):
         fig.plot_height = h
 
 
-def _create_mapper(adata, key):
+_MAPPER_CACHE = LRUCache(max_entries=128)
+
+
+def _create_mapper(adata, key, cmap='viridis'):
     """
     Helper function to create CategoricalColorMapper from annotated data.
 
@@ -112,39 +116,49 @@ def _create_mapper(adata, key):
             annotated data object
         key: str
             key in `adata.obs.obs_keys()` or `adata.var_names`, for which we want the colors; if no colors for given
-            column are found in `adata.uns[key_colors]`, use `viridis` palette
+            column are found in `adata.uns[key_colors]`, use `cmap`
+        cmap: str, optional (default: `'viridis'`)
+            name of the matplotlib colormap, sampled to at most 256 colors
 
     Returns
     --------
         mapper: bokeh.models.mappers.CategoricalColorMapper
             mapper which maps valuems from `adata.obs[key]` to colors
     """
-    if not key in adata.obs_keys():
+    if not key in adata.obs:
         assert key in adata.var_names,  f'`{key}` not found in `adata.obs_keys()` or `adata.var_names`'
-        ix = np.where(adata.var_names == key)[0][0]
-        vals = list(adata.X[:, ix])
-        palette = cm.get_cmap('viridis', adata.n_obs)
-
-        mapper = dict(zip(vals, range(len(vals))))
-        palette = to_hex_palette(palette([mapper[v] for v in vals]))
-
-        return LinearColorMapper(palette=palette, low=np.min(vals), high=np.max(vals))
-
-    is_categorical = adata.obs[key].dtype.name == 'category'
-    default_palette = cm.get_cmap('viridis', adata.n_obs if not is_categorical else len(adata.obs[key].unique()))
-    palette = adata.uns.get(f'{key}_colors', default_palette)
-
-    if palette is default_palette:
-        vals = adata.obs[key].unique() if is_categorical else adata.obs[key]
-        mapper = dict(zip(vals, range(len(vals))))
-        palette = palette([mapper[v] for v in vals])
-
-    palette = to_hex_palette(palette)
+        vals, colors, is_categorical = gene_vector(adata, key), None, False
+    else:
+        vals, colors = adata.obs[key], adata.uns.get(f'{key}_colors', None)
+        is_categorical = vals.dtype.name == 'category'
+
+    # bokeh models can't be shared between documents, only cache their arguments
+    # colormaps are keyed on their colors, their ids can be reused
+    n_colors = len(vals.cat.categories) if is_categorical else PALETTE_SIZE
+    if isinstance(cmap, str):
+        cmap_key = cmap
+    else:
+        lut = palette_lut(cmap, n_colors)
+        cmap_key = fingerprint(lut, identity=False, n_blocks=len(lut))
+    cache_key = (key, cmap_key, fingerprint(vals),
+                 None if colors is None else tuple(map(str, colors)))
+    spec = _MAPPER_CACHE.get(cache_key, None)
+
+    if spec is None:
+        if is_categorical:
+            factors = list(map(str, vals.cat.categories))
+            palette = list(to_hex_palette(colors)) if colors is not None else hex_palette(cmap, len(factors))
+            spec = (palette, factors)
+        else:
+            palette = list(to_hex_palette(colors)) if colors is not None else hex_palette(cmap)
+            spec = (palette, (np.min(vals), np.max(vals)))
+        _MAPPER_CACHE[cache_key] = spec
 
+    palette, args = spec
     if is_categorical:
-        return CategoricalColorMapper(palette=palette, factors=list(map(str, adata.obs[key].cat.categories)))
+        return CategoricalColorMapper(palette=palette, factors=args)
 
-    return LinearColorMapper(palette=palette, low=np.min(adata.obs[key]), high=np.max(adata.obs[key]))
+    return LinearColorMapper(palette=palette, low=args[0], high=args[1])
 
 
 def _smooth_expression(x, y, n_points=100, time_span=[None, None], mode='gp', kernel_params=dict(), kernel_default_params=dict(),
@@ -1017,7 +1031,8 @@ def highlight_de(adata, basis='umap', components=[1, 2], n_top_genes=10,
 def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
              subsample=None, steps=[40, 40], sample_size=500,
              distance=2, cutoff=True, highlight_only=None, palette=None,
-             show_legend=False, legend_loc='top_right', plot_width=None, plot_height=None, save=None):
+             show_legend=False, legend_loc='top_right', plot_width=None, plot_height=None, save=None,
+             seed=None, cache_dir=None):
     """
     Display the distances of cells from currently highlighted cell.
 
@@ -1059,14 +1074,16 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
         display the legend also in the linked plot
     legend_loc: str, optional (default `'top_right'`)
         location of the legend
-    seed: int, optional (default: `None`)
-        seed when `subsample='density'`
     plot_width: int, optional (default: `None`)
         width of the plot
     plot_height: int, optional (default: `None`)
         height of the plot
     save: Union[os.PathLike, Str, NoneType], optional (default: `None`)
         path where to save the plot
+    seed: int, optional (default: `None`)
+        seed when `subsample='density'`
+    cache_dir: Union[os.PathLike, Str, Bool, NoneType], optional (default: `None`)
+        directory where to persist the samples, if `False`, don't persist them
 
     Returns
     --------
@@ -1076,15 +1093,15 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
     assert key in adata.obs.keys(), f'`{key}` not found in `adata.obs`.'
 
     if subsample == 'uniform':
-        adata, _ = sample_unif(adata, steps, basis[0])
+        adata, _ = sample_unif(adata, steps, basis[0], cache_dir=cache_dir, copy=True)
     elif subsample == 'density':
-        adata, _ = sample_density(adata, sample_size, basis[0], seed=seed)
+        adata, _ = sample_density(adata, sample_size, basis[0], seed=seed, cache_dir=cache_dir, copy=True)
     elif subsample is not None:
         raise ValueError(f'Unknown subsample strategy: `{subsample}`.')
 
     palette = cm.RdYlBu if palette is None else palette
     if isinstance(palette, matplotlib.colors.Colormap):
-        palette = to_hex_palette(palette(range(palette.N), 1., bytes=True))
+        palette = hex_palette(palette)
 
     if not isinstance(components[0], list):
         components = [components]
@@ -1111,13 +1128,26 @@ def link_plot(adata, key, genes=None, basis=['umap', 'pca'], components=[1, 2],
         if not all(gene_subset):
             warnings.warn('`genes` is not None, are you sure this is what you want when using `dpt` distance?')
 
-        dmat = []
         ad_tmp = adata.copy()
         ad_tmp = ad_tmp[:, gene_subset]
-        for i in range(ad_tmp.n_obs):
-            ad_tmp.uns['iroot'] = i
+        if diffusion_pseudotime(ad_tmp) is None:
+            # computes the diffusion map if it's missing
+            ad_tmp.uns['iroot'] = 0
             sc.tl.dpt(ad_tmp)
-            dmat.append(list(ad_tmp.obs['dpt_pseudotime'].replace([np.nan, np.inf], [0, 1])))
+
+        engine = diffusion_pseudotime(ad_tmp)
+        if engine is not None:
+            dmat = np.empty((ad_tmp.n_obs, ad_tmp.n_obs), dtype=np.float64)
+            for roots, chunk in engine.chunks():
+                dmat[roots] = chunk
+            dmat[np.isnan(dmat)] = 0
+            dmat[np.isinf(dmat)] = 1
+        else:
+            dmat = []
+            for i in range(ad_tmp.n_obs):
+                ad_tmp.uns['iroot'] = i
+                sc.tl.dpt(ad_tmp)
+                dmat.append(list(ad_tmp.obs['dpt_pseudotime'].replace([np.nan, np.inf], [0, 1])))
 
     dmat = pd.DataFrame(dmat, columns=list(map(str, range(adata.n_obs))))
     df = pd.concat([pd.DataFrame(adata.obsm[f'X_{bs}'][:, comp - (bs != 'diffmap')], columns=[f'x{i}', f'y{i}'])
@@ -1224,9 +1254,16 @@ def _get_mappers(adata, df, genes=[], use_raw=True, sort=True):
     for k in filter(lambda k: k not in genes, mappers.keys()):
         df[k] = list(adata.obs[k].astype(float))
 
+    adata_mraw = adata.raw if use_raw else adata
     indices, = np.where(np.in1d(adata.var_names, genes))
-    for ix in indices:
-        df[adata.var_names[ix]] = (adata.raw if use_raw else adata).X[:, ix]
+    accessor = expression_accessor(adata_mraw)
+    if accessor is not None and len(indices):
+        # fetch all the genes at once
+        for ix, col in zip(indices, accessor.columns(indices).T):
+            df[adata.var_names[ix]] = col
+    else:
+        for ix in indices:
+            df[adata.var_names[ix]] = adata_mraw.X[:, ix]
 
     return df, mappers
 
@@ -298,7 +298,10 @@ def _scatter(adata, x, y, condition, by=None, subsample='datashade', steps=40, k
     
     data = pd.DataFrame(data)
     if categorical:
-        data['z'] = data['z'].astype('category')
+        codes = category_codes(condition, key=by)
+        data['z'] = codes.values
+        # same as sorting by `'z'`, but the order is computed only once
+        data = data.iloc[codes.order]
 
     if not vdims:
         vdims = None
@@ -311,7 +314,9 @@ def _scatter(adata, x, y, condition, by=None, subsample='datashade', steps=40, k
     kdims=[('x', 'x' if xlabel is None else xlabel),
            ('y', 'y' if ylabel is None else ylabel)]
 
-    scatter = hv.Scatter(data, kdims=kdims, vdims=vdims).sort('z')
+    scatter = hv.Scatter(data, kdims=kdims, vdims=vdims)
+    if not categorical:
+        scatter = scatter.sort('z')
     scatter = scatter.opts(size=size, xlim=xlim, ylim=ylim)
 
     kde_plot= None if kde is None else \
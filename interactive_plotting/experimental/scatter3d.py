@@ -14,7 +14,6 @@ from bokeh.io import save
 from bokeh.resources import CDN
 from bokeh.layouts import row
 from bokeh.plotting import figure
-from bokeh.colors import RGB
 from pandas.api.types import is_categorical_dtype
 from anndata import AnnData
 from typing import Union, Optional, Sequence, Tuple
@@ -58,23 +57,40 @@ class Surface3d(LayoutDOM):
     options = Dict(String, Any, default=_DEFAULT)
 
 
-def _to_hex_colors(values, cmap, perc=None):
+def _to_hex_colors(values, cmap, perc=None, packed=False):
+    if not isinstance(cmap, matplotlib.colors.Colormap):
+        # one bin per color, same as the colorbar's palette
+        cmap = matplotlib.colors.ListedColormap(cmap)
+    lut = palette_lut(cmap, cmap.N)
+
+    values = np.asarray(values, dtype=np.float64)
     minn, maxx = minmax(values, perc)
-    norm = matplotlib.colors.Normalize(vmin=minn, vmax=maxx, clip=True)
 
-    mapper = cm.ScalarMappable(norm=norm, cmap=cmap)
+    # same binning as `matplotlib.colors.Colormap`
+    is_nan = np.isnan(values)
+    ixs = np.where(is_nan, 0, (values - minn) / ((maxx - minn) if maxx > minn else 1) * len(lut))
+    rgba = lut[np.clip(ixs, 0, len(lut) - 1).astype(np.int64)]
+    # missing values get the colormap's bad color
+    rgba[is_nan] = palette_lut([cmap(np.nan)])[0]
+
+    return (pack_rgba(rgba) if packed else rgba_to_hex(rgba).tolist()), minn, maxx
+
+
+def _codes_to_hex_colors(codes, hex_palette, default='#AAAAAA'):
+    # categories without a color and missing values (code `-1`) get the default
+    palette = np.append(np.asarray(hex_palette, dtype='U7'), default)
+    codes = np.asarray(codes)
 
-    return [matplotlib.colors.to_hex(mapper.to_rgba(v)) for v in values], minn, maxx
+    return palette[np.where((codes >= 0) & (codes < len(hex_palette)), codes, len(hex_palette))].tolist()
 
 
 def _mpl_to_hex_palette(cmap):
     if isinstance(cmap, matplotlib.colors.ListedColormap):
-        rgb_cmap = (255 * cmap(range(256))).astype('int')
-        return [RGB(*tuple(rgb)).to_hex() for rgb in rgb_cmap]
+        return rgba_to_hex(cmap(range(256))).tolist()
 
     assert all(map(lambda c: matplotlib.colors.is_color_like(c), cmap)), 'Not all colors are color-like.'
 
-    return [matplotlib.colors.to_hex(c) for c in cmap]
+    return rgba_to_hex(matplotlib.colors.to_rgba_array(cmap)).tolist()
 
 
 
@@ -95,7 +111,8 @@ def scatter3d(adata: AnnData,
               show_legend: bool = True,
               show_cbar: bool = True,
               plot_height: Optional[int] = 1400,
-              plot_width: Optional[int] = 1400):
+              plot_width: Optional[int] = 1400,
+              cache_dir: Optional[str] = None):
     """
     Parameters
     ----------
@@ -136,6 +153,8 @@ def scatter3d(adata: AnnData,
         Height of the plot in pixels. If `None`, try getting the screen height.
     plot_width
         Width of the plot in pixels. If `None`, try getting the screen width.
+    cache_dir
+        Directory where to persist the sampled indices. If `False`, don't persist them.
 
     Returns
     -------
@@ -166,7 +185,7 @@ def scatter3d(adata: AnnData,
     colors = adata.uns.get(f'{key}_colors', None)
     if steps is not None:
         # this somehow destroys the colors
-        adata, _ = sample_unif(adata, steps, bs=basis, components=components)
+        adata, _ = sample_unif(adata, steps, bs=basis, components=components, cache_dir=cache_dir)
 
     data = dict(x=adata.obsm[basis_key][:, components[0]],
                 y=adata.obsm[basis_key][:, components[1]],
@@ -182,7 +201,7 @@ def scatter3d(adata: AnnData,
         hex_palette = _mpl_to_hex_palette(cmap)
 
         mapper = defaultdict(lambda: '#AAAAAA', zip(adata.obs[key].cat.categories, hex_palette))
-        colors = [str(mapper[c]) for c in adata.obs[key]]
+        colors = _codes_to_hex_colors(adata.obs[key].cat.codes, hex_palette)
 
         n_cls = len(adata.obs[key].cat.categories)
         _ = fig.circle([0] * n_cls, [0] * n_cls,
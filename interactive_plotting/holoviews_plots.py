@@ -12,7 +12,7 @@ from datashader.colors import Sets1to3
 from pandas.core.indexes.base import Index
 from holoviews.operation.datashader import datashade, bundle_graph, shade, dynspread, rasterize, spread
 from holoviews.operation import decimate
-from bokeh.models import HoverTool
+from bokeh.models import HoverTool, CustomJS, LinearColorMapper, Slider, Select
 
 import scanpy as sc
 import numpy as np
@@ -20,7 +20,9 @@ import pandas as pd
 import networkx as nx
 import holoviews as hv
 import datashader as ds
+import param
 import warnings
+import weakref
 
 
 try:
@@ -31,11 +33,317 @@ except AssertionError:
 
 #TODO: DRY
 
+def _picker_stream(picker, name):
+    # stream which supplies the value selected in `ConditionPicker` as `name`
+    stream = hv.streams.Stream.define(f'{name.title()}Picker', **{name: picker.value})()
+    picker.watch(lambda value: stream.event(**{name: value}))
+
+    return stream
+
+
+_PSEUDOTIME_CACHE = LRUCache(max_entries=PSEUDOTIME_CACHE_MAX_ENTRIES)
+
+
+def _dpt_token(adata):
+    # fingerprint of the data `dpt` reads, the neighbors graph and the diffusion map
+    objs = (get_connectivities(adata),
+            adata.obsm['X_diffmap'] if 'X_diffmap' in adata.obsm.keys() else None,
+            adata.uns.get('diffmap_evals', None))
+
+    return (adata.n_obs, ) + tuple(None if obj is None else fingerprint(obj) for obj in objs)
+
+
+def _pseudotime(adata, root_cell, *args, **kwargs):
+    '''
+    Get the diffusion pseudotime from a root cell.
+
+    It's computed once per root cell, `dpt` arguments and data,
+    and shared by all the plots. When the diffusion map is present
+    and only `n_dcs` and `n_branchings=0` are specified,
+    it's computed from it directly, otherwise using `sc.tl.dpt`.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    root_cell: Str
+        name of the root cell
+    *args, **kwargs:
+        additional arguments for `sc.tl.dpt`
+
+    Returns
+    --------
+    pseudotime: np.ndarray
+        read-only pseudotime of all the cells
+    '''
+
+    params = (root_cell, repr(args), repr(sorted(kwargs.items())))
+    key = params + _dpt_token(adata)
+    pseudotime = _PSEUDOTIME_CACHE.get(key, None)
+    if pseudotime is not None:
+        return pseudotime
+
+    iroot = np.where(adata.obs_names == root_cell)[0][0]
+    # any other argument, e.g. `neighbors_key`, is only understood by `sc.tl.dpt`
+    engine = diffusion_pseudotime(adata, kwargs.get('n_dcs', DPT_N_DCS)) \
+        if not args and set(kwargs) <= {'n_dcs', 'n_branchings'} and kwargs.get('n_branchings', 0) == 0 else None
+
+    if engine is not None:
+        pseudotime = engine(iroot)
+    else:
+        adata.uns['iroot'] = iroot
+        dpt_fn(adata, *args, **kwargs)
+        pseudotime = np.array(adata.obs['dpt_pseudotime'].values, dtype=np.float64)
+
+    pseudotime.setflags(write=False)
+    # `dpt` may have computed the diffusion map
+    _PSEUDOTIME_CACHE[key] = _PSEUDOTIME_CACHE[params + _dpt_token(adata)] = pseudotime
+
+    return pseudotime
+
+
+class AggregationCache:
+    '''
+    Aggregates of the elements of a single plot.
+
+    The keys set by `set_aggregate_key` are only unique within a plot,
+    so each plot has its own cache.
+    '''
+
+    def __init__(self):
+        self.aggregates = LRUCache(max_entries=AGGREGATE_CACHE_MAX_ENTRIES, max_bytes=AGGREGATE_CACHE_MAX_BYTES)
+        self.pyramids = LRUCache(max_bytes=PYRAMID_CACHE_MAX_BYTES)
+        self.pixels = LRUCache(max_entries=PIXEL_INDEX_CACHE_MAX_ENTRIES)
+
+
+class _CachedAggregation:
+    # shared by `cached_rasterize` and `cached_datashade`
+
+    def process_element(self, element, key, **params):
+        for rng in ('x_range', 'y_range'):
+            if rng in params:
+                params[rng] = quantize_range(params[rng])
+
+        return super().process_element(element, key, **params)
+
+    def _aggregate(self, element, key=None):
+        agg_key = get_aggregate_key(element)
+        if agg_key is None or self.p.cache is None:
+            return rasterize._process(self, element, key)
+
+        aggregator = self.p.aggregator
+        agg_key += ((type(aggregator).__name__, getattr(aggregator, 'column', aggregator)), self.p.tiles)
+        view_key = agg_key + (self.p.x_range, self.p.y_range, self.p.width, self.p.height)
+        try:
+            agg = self.p.cache.aggregates[view_key]
+        except KeyError:
+            if self.p.tiles and isinstance(aggregator, (ds.mean, ds.count_cat)):
+                agg = self._aggregate_tiles(element, agg_key)
+            elif isinstance(aggregator, ds.count_cat) and is_categorical(self._values(element, aggregator.column)):
+                agg = self._aggregate_pixels(element)
+            else:
+                agg = rasterize._process(self, element, key)
+            self.p.cache.aggregates[view_key] = agg
+
+        return agg
+
+    @staticmethod
+    def _values(element, column):
+        return element.data[column].values if isinstance(element.data, pd.DataFrame) \
+            else element.dimension_values(column)
+
+    @staticmethod
+    def _to_element(element, column, xs, ys, agg, categories=None):
+        # same elements as `rasterize` creates
+        kdims = element.kdims[:2]
+        if categories is None:
+            return hv.Image((xs, ys, agg), kdims=kdims, vdims=[column], datatype=['xarray'])
+
+        return hv.NdOverlay({cat: hv.Image((xs, ys, agg[..., i]), kdims=kdims, vdims=['Count'], datatype=['xarray'])
+                             for i, cat in enumerate(categories)}, kdims=[element.get_dimension(column)])
+
+    def _aggregate_tiles(self, element, agg_key):
+        column = self.p.aggregator.column
+        try:
+            pyramid = self.p.cache.pyramids[agg_key]
+        except KeyError:
+            pyramid = self.p.cache.pyramids[agg_key] = TilePyramid(element.dimension_values(0),
+                                                                   element.dimension_values(1),
+                                                                   self._values(element, column))
+
+        xs, ys, agg = pyramid.query(self.p.x_range, self.p.y_range, self.p.width, self.p.height)
+
+        return self._to_element(element, column, xs, ys, agg, pyramid.categories)
+
+    def _aggregate_pixels(self, element):
+        # the pixels depend only on the coordinates, so switching
+        # between conditions of the same points is just a `bincount`
+        column = self.p.aggregator.column
+        x, y = (element.dimension_values(i) for i in range(2))
+        x_range = element.range(0) if self.p.x_range is None else self.p.x_range
+        y_range = element.range(1) if self.p.y_range is None else self.p.y_range
+
+        key = (fingerprint(x, identity=False), fingerprint(y, identity=False),
+               x_range, y_range, self.p.width, self.p.height)
+        try:
+            pixels = self.p.cache.pixels[key]
+        except KeyError:
+            pixels = self.p.cache.pixels[key] = PixelIndex(x, y, x_range, y_range, self.p.width, self.p.height)
+
+        values = self._values(element, column)
+        agg = pixels.count_cat(values.codes, len(values.categories))
+
+        return self._to_element(element, column, pixels.xs, pixels.ys, agg, values.categories)
+
+
+class cached_rasterize(_CachedAggregation, rasterize):
+    '''
+    `rasterize` which caches the aggregates of elements identified by `set_aggregate_key`.
+
+    The viewport is quantized, so that revisiting a view or a condition is just a lookup.
+    '''
+
+    cache = param.ClassSelector(class_=AggregationCache, default=None, allow_None=True, doc='''
+        Cache of the plot, if `None`, the aggregates are not cached.''')
+
+    tiles = param.Boolean(default=False, doc='''
+        Whether to aggregate from a `TilePyramid` of the element, computed once,
+        instead of from all the points.''')
+
+    def _process(self, element, key=None):
+        return self._aggregate(element, key)
+
+
+class cached_datashade(_CachedAggregation, datashade):
+    '''
+    `datashade` which caches the aggregates of elements identified by `set_aggregate_key`.
+
+    The viewport is quantized, so that revisiting a view or a condition is just a lookup.
+    '''
+
+    cache = param.ClassSelector(class_=AggregationCache, default=None, allow_None=True, doc='''
+        Cache of the plot, if `None`, the aggregates are not cached.''')
+
+    tiles = param.Boolean(default=False, doc='''
+        Whether to aggregate from a `TilePyramid` of the element, computed once,
+        instead of from all the points.''')
+
+    def _process(self, element, key=None):
+        return shade._process(self, self._aggregate(element, key), key)
+
+
+# `quantiles` is the table of `Quantiles`, `low` and `high` the percentile sliders
+_CLIM_JS = '''
+const n = quantiles.length - 1
+const at = (perc) => {
+    const x = Math.min(Math.max(perc, 0), 100) / 100 * n
+    const i = Math.max(Math.min(Math.floor(x), n - 1), 0)
+    return n > 0 ? quantiles[i] + (quantiles[i + 1] - quantiles[i]) * (x - i) : quantiles[0]
+}
+const perc = [low.value, high.value].sort((a, b) => a - b)
+mapper.low = at(perc[0])
+mapper.high = at(perc[1])
+mapper.palette = palettes[cmap.value]
+'''
+
+
+class ColorControls:
+    '''
+    Percentile sliders and colormap selection applied in the browser.
+
+    The color mappers of the plots using `hook` are updated by a `CustomJS` callback
+    from the quantiles of the plotted values, so the data is sent only once.
+
+    Params
+    --------
+    perc: List[Float]
+        initial lower and upper percentile, `None` means `0` and `100`, respectively
+    cmap: Union[Str, List[Str], matplotlib.colors.Colormap]
+        initial colormap, the others are `CLIENT_CMAPS`
+    show_perc: Bool, optional (default: `True`)
+        whether to include the percentile sliders in the widgets
+    '''
+
+    def __init__(self, perc, cmap, show_perc=True):
+        self.palettes = odict([('default', hex_palette(cmap))] + [(c, hex_palette(c)) for c in CLIENT_CMAPS])
+        self.low = Slider(title='Percentile (lower)', start=0, end=100, step=0.1,
+                          value=0 if perc[0] is None else perc[0])
+        self.high = Slider(title='Percentile (upper)', start=0, end=100, step=0.1,
+                           value=100 if perc[1] is None else perc[1])
+        self.cmap = Select(title='Colormap', value='default', options=list(self.palettes.keys()))
+        self.show_perc = show_perc
+        self._quantiles = dict()  # by `id` of the elements
+
+    @property
+    def widgets(self):
+        return ([self.low, self.high] if self.show_perc else []) + [self.cmap]
+
+    def link(self, element, quantiles):
+        '''
+        Use `quantiles` for the color limits of `element`.
+
+        Params
+        --------
+        element: holoviews.Element
+            element whose color mapper will be updated
+        quantiles: Quantiles
+            quantiles of the plotted values
+
+        Returns
+        --------
+        element: holoviews.Element
+            the element with color limits from the current percentiles
+        '''
+
+        self._set_quantiles(element, quantiles)
+
+        return element.opts(clim=quantiles((self.low.value, self.high.value)), clone=False)
+
+    def _set_quantiles(self, element, quantiles):
+        if id(element) not in self._quantiles:
+            weakref.finalize(element, self._quantiles.pop, id(element), None)
+        self._quantiles[id(element)] = quantiles
+
+    def _get_quantiles(self, element):
+        quantiles = self._quantiles.get(id(element), None)
+        if quantiles is None and len(getattr(element, 'vdims', [])):
+            # e.g. rasterized or decimated values
+            quantiles = Quantiles(element.dimension_values(element.vdims[0]))
+            self._set_quantiles(element, quantiles)
+
+        return quantiles
+
+    def hook(self, plot, element):
+        '''
+        Link the color mapper of the plot to the widgets, used as `.opts(hooks=[controls.hook])`.
+        '''
+
+        mapper = plot.handles.get('color_mapper', None)
+        quantiles = self._get_quantiles(element)
+        if not isinstance(mapper, LinearColorMapper) or quantiles is None:
+            return
+
+        low, high = quantiles((self.low.value, self.high.value))
+        mapper.update(low=low, high=high, palette=self.palettes[self.cmap.value])
+
+        args = dict(mapper=mapper, low=self.low, high=self.high, cmap=self.cmap,
+                    palettes=dict(self.palettes), quantiles=quantiles.table.tolist())
+        callback = plot.handles.get('clim_callback', None)
+        if callback is None:
+            callback = plot.handles['clim_callback'] = CustomJS(args=args, code=_CLIM_JS)
+            for widget in (self.low, self.high, self.cmap):
+                widget.js_on_change('value', callback)
+        else:
+            # e.g. the condition has changed
+            callback.args = args
+
+
 @wrap_as_panel
 def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
             obsm_keys=None, use_raw=False, subsample='datashade', steps=40, keep_frac=None, lazy_loading=True,
             default_obsm_ixs=[0], sort=True, skip=True, seed=None, cols=None, size=4,
-            perc=None, show_perc=True, cmap=None, plot_height=400, plot_width=400, save=None):
+            perc=None, show_perc=True, cmap=None, plot_height=400, plot_width=400, save=None,
+            prefetch=False, n_jobs=1, progress=None, tiles=False, client_side=False):
     '''
     Scatter plot for continuous observations.
 
@@ -61,15 +369,16 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
         use `adata.raw` for gene expression levels
     subsample: Str, optional (default: `'datashade'`)
         subsampling strategy for large data
-        possible values are `None, 'none', 'datashade', 'decimate', 'density', 'uniform'`
+        possible values are `None, 'none', 'datashade', 'decimate', 'density', 'uniform', 'lod'`
         using `subsample='datashade'` is preferred over other options since it does not subset
         when using `subsample='datashade'`, colorbar is not visible
         `'density'` and `'uniform'` use first element of `basis` for their computation
+        `'lod'` shows more cells when zooming in, up to `keep_frac * adata.n_obs` per frame
     steps: Union[Int, Tuple[Int, Int]], optional (default: `40`)
         step size when the embedding directions
         larger step size corresponds to higher density of points
     keep_frac: Float, optional (default: `adata.n_obs / 5`)
-        number of observations to keep when `subsample='decimate'`
+        number of observations to keep when `subsample='decimate'`, `'density'` or `'lod'`
     lazy_loading: Bool, optional (default: `False`)
         only visualize when necessary
         for notebook sharing, consider using `lazy_loading=False`
@@ -105,6 +414,22 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
         width of the plot in pixels
     save: Union[os.PathLike, Str, NoneType], optional (default: `None`)
         path where to save the plot
+    prefetch: Union[Bool, Int], optional (default: `False`)
+        whether to compute the samples for all basis and their adjacent components
+        in the background, used when `subsample='uniform'`, `'density'` or `'lod'`
+        if integer, it specifies the number of threads
+    n_jobs: Int, optional (default: `1`)
+        number of threads used to create the plots when `lazy_loading=False`
+        if `< 1`, use all the available cores
+    progress: Callable, optional (default: `None`)
+        called as `progress(n_done, n_total)` after each plot is created when `lazy_loading=False`
+    tiles: Bool, optional (default: `False`)
+        whether to precompute a pyramid of aggregates for each condition and answer
+        pan and zoom from it, used when `subsample='datashade'`
+    client_side: Bool, optional (default: `False`)
+        whether to change the percentiles and the colormap in the browser,
+        without sending the data again, only when `lazy_loading=True`
+        when `subsample='datashade'`, the data is rasterized and colormapped in the browser
 
     Returns
     --------
@@ -112,7 +437,35 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
         holoviews plot wrapped in `panel.panel`
     '''
 
-    def create_scatterplot(gene, perc_low, perc_high, *args, bs=None):
+    def create_scatterplot(gene, perc_low, perc_high, *args, bs=None, x_range=None, y_range=None, data=None):
+        if perc_low is not None and perc_high is not None:
+            if perc_low > perc_high:
+                perc_low, perc_high = perc_high, perc_low
+            perc = [perc_low, perc_high]
+        else:
+            perc = None
+
+        # when only the percentiles change, the same element is returned with new color limits,
+        # which updates just the color mapper
+        key = (gene, bs, args, x_range, y_range)
+        try:
+            scatter, quantiles = elements[key]
+        except KeyError:
+            if data is None:
+                data = _scatter_data(gene, *args, bs=bs, x_range=x_range, y_range=y_range)
+            scatter, quantiles = elements[key] = _scatter_element(*data)
+
+        if subsample == 'datashade':
+            # colors are determined by the shading or the rasterized values
+            return scatter
+
+        if controls is not None:
+            return controls.link(scatter, quantiles)
+
+        return scatter.opts(clim=quantiles(perc), clone=False)
+
+    def _scatter_data(gene, *args, bs=None, x_range=None, y_range=None):
+        # only the data, the element is created by `_scatter_element`
         ixs = np.where(basis == bs)[0][0]
         is_diffmap = bs == 'diffmap'
 
@@ -122,25 +475,15 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
         else:
             comp = np.array(components[ixs])  # need to make a copy
 
-        if perc_low is not None and perc_high is not None:
-            if perc_low > perc_high:
-                perc_low, perc_high = perc_high, perc_low
-            perc = [perc_low, perc_high]
-        else:
-            perc = None
-
-        ad, _ = alazy[bs, tuple(comp)]
+        ad, _ = alazy.query((bs, tuple(comp)), x_range, y_range, scale=1000 if is_diffmap else 1)
         ad_mraw = ad.raw if use_raw else ad
 
         # because diffmap has small range, it iterferes with
         # the legend created
-        emb = ad.obsm[f'X_{bs}'][:, comp] * (1000 if is_diffmap else 1)
+        points = ad.points(bs, comp, scale=1000 if is_diffmap else 1)
         comp += not is_diffmap  # naming consistence
 
-        bsu = bs.upper()
-        x = hv.Dimension('x', label=f'{bsu}{comp[0]}')
-        y = hv.Dimension('y', label=f'{bsu}{comp[1]}')
-
+        ix = None
         #if ignore_after is not None and ignore_after in gene:
         if gene in ad.obsm.keys():
             data = ad.obsm[gene][:, 0]
@@ -153,25 +496,43 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
             ix = int(ix)
             data = ad.obsm[gene][:, ix]
 
-        data = np.array(data, dtype=np.float64)
+        points['gene'] = np.asarray(data, dtype=np.float64)
 
-        # we need to clip the data as well
-        scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'gene': data},
-                             kdims=[x, y], vdims='gene')
+        return points, (gene, ix, bs, tuple(comp)), Quantiles(points['gene'].values)
 
-        return scatter.opts(cmap=cmap, color='gene',
-                            colorbar=True,
-                            colorbar_opts={'width': CBW},
-                            size=size,
-                            clim=minmax(data, perc=perc),
-                            xlim=minmax(emb[:, 0]),
-                            ylim=minmax(emb[:, 1]),
-                            xlabel=f'{bsu}{comp[0]}',
-                            ylabel=f'{bsu}{comp[1]}')
+    def _scatter_element(points, agg_key, quantiles):
+        _, _, bs, comp = agg_key
+        is_diffmap = bs == 'diffmap'
+        # not the extent of `points`, it's only the viewport in the `'lod'` mode
+        xlim, ylim = alazy.limits((bs, tuple(np.array(comp) - (not is_diffmap))), scale=1000 if is_diffmap else 1)
+        bsu = bs.upper()
+        x = hv.Dimension('x', label=f'{bsu}{comp[0]}')
+        y = hv.Dimension('y', label=f'{bsu}{comp[1]}')
 
-    def _create_scatterplot_nl(bs, gene, perc_low, perc_high, *args):
+        # we need to clip the data as well
+        scatter = hv.Scatter(points, kdims=[x, y], vdims='gene')
+        set_aggregate_key(scatter, *agg_key)
+
+        scatter = scatter.opts(cmap=cmap, color='gene',
+                               colorbar=True,
+                               colorbar_opts={'width': CBW},
+                               size=size,
+                               xlim=xlim,
+                               ylim=ylim,
+                               xlabel=f'{bsu}{comp[0]}',
+                               ylabel=f'{bsu}{comp[1]}')
+
+        return scatter, quantiles
+
+    def _prepare_scatterplot(gene, bs):
+        points, agg_key, quantiles = _scatter_data(gene, bs=bs)
+        if subsample != 'datashade':
+            quantiles()  # build the table in the worker as well
+        return points, agg_key, quantiles
+
+    def _create_scatterplot_nl(bs, gene, perc_low, perc_high, *args, **kwargs):
         # arg switching
-        return create_scatterplot(gene, perc_low, perc_high, *args, bs=bs)
+        return create_scatterplot(gene, perc_low, perc_high, *args, bs=bs, **kwargs)
 
     if perc is None:
         perc = [None, None]
@@ -194,11 +555,13 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
 
     if subsample == 'uniform':
         cb_kwargs = {'steps': steps}
-    elif subsample == 'density':
+    elif subsample in ('density', 'lod'):
         cb_kwargs = {'size': int(keep_frac * adata.n_obs), 'seed': seed}
     else:
         cb_kwargs = {}
     alazy = SamplingLazyDict(adata, subsample, callback_kwargs=cb_kwargs)
+    elements = LRUCache(max_entries=ELEMENT_CACHE_MAX_ENTRIES)
+    aggregates = AggregationCache()
     adata_mraw = adata.raw if use_raw else adata  # maybe raw
 
     if obs_keys is None:
@@ -266,6 +629,10 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
         assert f'X_{bs}' in adata.obsm.keys(), f'`X_{bs}` not found in `adata.obsm`'
         assert shape[-1] > np.max(comp), f'Requested invalid components `{list(comp)}` for basis `X_{bs}` with shape `{shape}`.'
 
+    if prefetch:
+        alazy.prefetch(component_pairs(adata, basis, components),
+                       n_jobs=None if isinstance(prefetch, bool) else prefetch)
+
     if adata.n_obs > SUBSAMPLE_THRESH and subsample in NO_SUBSAMPLE:
         warnings.warn(f'Number of cells `{adata.n_obs}` > `{SUBSAMPLE_THRESH}`. Consider specifying `subsample={SUBSAMPLING_STRATEGIES}`.')
 
@@ -280,15 +647,23 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
              hv.Dimension('Percentile (lower)', range=(0, 100), step=0.1, type=float, default=0 if perc[0] is None else perc[0]),
              hv.Dimension('Percentile (upper)', range=(0, 100), step=0.1, type=float, default=100 if perc[1] is None else perc[1])]
 
+    # percentiles are changed in the browser
+    controls = ColorControls(perc, cmap, show_perc=show_perc) if client_side and lazy_loading else None
+
     cs = create_scatterplot
     _cs = _create_scatterplot_nl
-    if not show_perc or subsample == 'datashade' or not lazy_loading:
+    if not show_perc or subsample == 'datashade' or not lazy_loading or controls is not None:
         kdims = kdims[:2]
         cs = lambda gene, *args, **kwargs: create_scatterplot(gene, perc[0], perc[1], *args, **kwargs)
         _cs = lambda bs, gene, *args, **kwargs: _create_scatterplot_nl(bs, gene, perc[0], perc[1], *args, **kwargs)
 
+    pickers = odict()
     if not lazy_loading:
-        dynmaps = [hv.HoloMap({(g, b):cs(g, bs=b) for g in conditions for b in basis}, kdims=kdims[::-1])]
+        keys = [(g, b) for g in conditions for b in basis]
+        # HoloViews options aren't thread-safe, the workers only prepare the data
+        data = parallel_map(_prepare_scatterplot, keys, n_jobs=n_jobs, progress=progress)
+        plots = [cs(g, bs=b, data=d) for (g, b), d in zip(keys, data)]
+        dynmaps = [hv.HoloMap(dict(zip(keys, plots)), kdims=kdims[::-1])]
     else:
         for bs, comp in zip(basis, components):
             kdims.append(hv.Dimension(f'{bs.upper()}[X]',
@@ -297,14 +672,29 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
             kdims.append(hv.Dimension(f'{bs.upper()}[Y]',
                                       type=int, default=2, step=1,
                                       range=(1, adata.obsm[f'X_{bs}'].shape[-1])))
+
+        if len(conditions) > SEARCH_THRESH:
+            # too many values for a dropdown, the condition is supplied by a stream
+            pickers['condition'] = ConditionPicker('Condition', conditions)
+            kdims.pop(1)
+            cs, _cs = kwarg_as_arg(cs, 0, 'condition'), kwarg_as_arg(_cs, 1, 'condition')
+
+        # refine the sample when the viewport changes
+        streams = lambda: ([hv.streams.RangeXY(transient=True)] if subsample == 'lod' else []) + \
+                          [_picker_stream(p, n) for n, p in pickers.items()]
         if cols is None:
-            dynmaps = [hv.DynamicMap(_cs, kdims=kdims)]
+            dynmaps = [hv.DynamicMap(_cs, kdims=kdims, streams=streams())]
         else:
-            dynmaps = [hv.DynamicMap(partial(cs, bs=bs), kdims=kdims[1:]) for bs in basis]
+            dynmaps = [hv.DynamicMap(partial(cs, bs=bs), kdims=kdims[1:], streams=streams()) for bs in basis]
 
-    if subsample == 'datashade':
-        dynmaps = [dynspread(datashade(d, aggregator=ds.mean('gene'), color_key='gene',
-                                       cmap=cmap, streams=[hv.streams.RangeXY(transient=True)]),
+    if subsample == 'datashade' and controls is not None:
+        dynmaps = [cached_rasterize(d, aggregator=ds.mean('gene'), tiles=tiles, cache=aggregates,
+                                    streams=[hv.streams.RangeXY(transient=True)])
+                   .opts(cmap=cmap, colorbar=True, colorbar_opts={'width': CBW})
+                   for d in dynmaps]
+    elif subsample == 'datashade':
+        dynmaps = [dynspread(cached_datashade(d, aggregator=ds.mean('gene'), color_key='gene', tiles=tiles,
+                                       cmap=cmap, streams=[hv.streams.RangeXY(transient=True)], cache=aggregates),
                              threshold=0.8, max_px=5)
                    for d in dynmaps]
     elif subsample == 'decimate':
@@ -312,6 +702,8 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
                             streams=[hv.streams.RangeXY(transient=True)], random_seed=seed) for d in dynmaps]
 
     dynmaps = [d.opts(framewise=True, axiswise=True, frame_height=plot_height, frame_width=plot_width) for d in dynmaps]
+    if controls is not None:
+        dynmaps = [d.opts(hooks=[controls.hook]) for d in dynmaps]
 
     if cols is None:
         plot = dynmaps[0].opts(title='', frame_height=plot_height, frame_width=plot_width)
@@ -321,6 +713,10 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
     if save is not None:
         hv.renderer('bokeh').save(plot, save)
 
+    widgets = [p.widget for p in pickers.values()] + ([] if controls is None else controls.widgets)
+    if len(widgets):
+        return plot, widgets
+
     return plot
 
 
@@ -328,7 +724,8 @@ def scatter(adata, genes=None, basis=None, components=(1, 2), obs_keys=None,
 def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
              obsm_keys=None, subsample='datashade', steps=40, keep_frac=None, hover=False, lazy_loading=True,
              default_obsm_ixs=[0], sort=True, skip=True, seed=None, legend_loc='top_right', cols=None, size=4,
-             cmap=None, show_legend=True, plot_height=400, plot_width=400, save=None):
+             cmap=None, show_legend=True, plot_height=400, plot_width=400, save=None,
+             prefetch=False, n_jobs=1, progress=None, tiles=False):
     '''
     Scatter plot for categorical observations.
 
@@ -349,15 +746,16 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
         if `None`, get all available
     subsample: Str, optional (default: `'datashade'`)
         subsampling strategy for large data
-        possible values are `None, 'none', 'datashade', 'decimate', 'density', 'uniform'`
+        possible values are `None, 'none', 'datashade', 'decimate', 'density', 'uniform', 'lod'`
         using `subsample='datashade'` is preferred over other options since it does not subset
         when using `subsample='datashade'`, colorbar is not visible
         `'density'` and `'uniform'` use first element of `basis` for their computation
+        `'lod'` shows more cells when zooming in, up to `keep_frac * adata.n_obs` per frame
     steps: Union[Int, Tuple[Int, Int]], optional (default: `40`)
         step size when the embedding directions
         larger step size corresponds to higher density of points
     keep_frac: Float, optional (default: `adata.n_obs / 5`)
-        number of observations to keep when `subsample='decimate'`
+        number of observations to keep when `subsample='decimate'`, `'density'` or `'lod'`
     hover: Union[Bool, Int], optional (default: `False`)
         whether to display cell index when hovering over a block
         if integer, it specifies the number of rows/columns (defualt: `10`)
@@ -387,6 +785,18 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
         width of the plot in pixels
     save: Union[os.PathLike, Str, NoneType], optional (default: `None`)
         path where to save the plot
+    prefetch: Union[Bool, Int], optional (default: `False`)
+        whether to compute the samples for all basis and their adjacent components
+        in the background, used when `subsample='uniform'`, `'density'` or `'lod'`
+        if integer, it specifies the number of threads
+    n_jobs: Int, optional (default: `1`)
+        number of threads used to create the plots when `lazy_loading=False`
+        if `< 1`, use all the available cores
+    progress: Callable, optional (default: `None`)
+        called as `progress(n_done, n_total)` after each plot is created when `lazy_loading=False`
+    tiles: Bool, optional (default: `False`)
+        whether to precompute a pyramid of aggregates for each condition and answer
+        pan and zoom from it, used when `subsample='datashade'`
 
     Returns
     --------
@@ -418,7 +828,11 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
 
         return [s.opts(tools=[hovertool]) for s in subsampled]
 
-    def create_scatterplot(cond, *args, bs=None):
+    def create_scatterplot(cond, *args, bs=None, x_range=None, y_range=None):
+        return _scatter_element(*_scatter_data(cond, *args, bs=bs, x_range=x_range, y_range=y_range))
+
+    def _scatter_data(cond, *args, bs=None, x_range=None, y_range=None):
+        # only the data, the element is created by `_scatter_element`
         ixs = np.where(basis == bs)[0][0]
         is_diffmap = bs == 'diffmap'
 
@@ -429,40 +843,51 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
             comp = np.array(components[ixs])  # need to make a copy
 
         # subsample is uniform or density
-        ad, ixs = alazy[bs, tuple(comp)]
-        # because diffmap has small range, it interferes with the legend
-        emb = ad.obsm[f'X_{bs}'][:, comp] * (1000 if is_diffmap else 1)
-        comp += not is_diffmap  # naming consistence
-
-        bsu = bs.upper()
-        x = hv.Dimension('x', label=f'{bsu}{comp[0]}')
-        y = hv.Dimension('y', label=f'{bsu}{comp[1]}')
-
+        ad, ixs = alazy.query((bs, tuple(comp)), x_range, y_range, scale=1000 if is_diffmap else 1)
+        ix = None
         #if ignore_after is not None and ignore_after in gene:
         if cond in ad.obsm.keys():
-            data = ad.obsm[cond][:, 0]
+            codes = ad.codes(cond, 0)
         elif cond in ad.obs.keys():
-            data = ad.obs[cond]
+            codes = ad.codes(cond)
         else:
             cond, ix = cond.split(ignore_after)
             ix = int(ix)
-            data = ad.obsm[cond][:, ix]
+            codes = ad.codes(cond, ix)
+
+        # same as sorting by `'cond'`, but the order and the reordered coordinates are computed only once,
+        # with datashade, the order doesn't matter and all the conditions share the coordinates
+        order = codes.order if subsample != 'datashade' else None
+        # because diffmap has small range, it interferes with the legend
+        points = ad.points(bs, comp, scale=1000 if is_diffmap else 1, order=order,
+                           cond=codes.values, index=np.asarray(ixs))
+        comp += not is_diffmap  # naming consistence
+
+        return points, (cond, ix, bs, tuple(comp))
+
+    def _scatter_element(points, agg_key):
+        cond, _, bs, comp = agg_key
+        is_diffmap = bs == 'diffmap'
+        # not the extent of `points`, it's only the viewport in the `'lod'` mode
+        xlim, ylim = alazy.limits((bs, tuple(np.array(comp) - (not is_diffmap))), scale=1000 if is_diffmap else 1)
+        bsu = bs.upper()
+        x = hv.Dimension('x', label=f'{bsu}{comp[0]}')
+        y = hv.Dimension('y', label=f'{bsu}{comp[1]}')
 
-        data = pd.Categorical(data).as_ordered()
-        scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'cond': data, 'index': ixs},
-                             kdims=[x, y], vdims=['cond', 'index']).sort('cond')
+        scatter = hv.Scatter(points, kdims=[x, y], vdims=['cond', 'index'])
+        set_aggregate_key(scatter, *agg_key)
 
         return scatter.opts(color_index='cond', cmap=cmaps[cond],
                             show_legend=show_legend,
                             legend_position=legend_loc,
                             size=size,
-                            xlim=minmax(emb[:, 0]),
-                            ylim=minmax(emb[:, 1]),
+                            xlim=xlim,
+                            ylim=ylim,
                             xlabel=f'{bsu}{comp[0]}',
                             ylabel=f'{bsu}{comp[1]}')
 
-    def _cs(bs, cond, *args):
-        return create_scatterplot(cond, *args, bs=bs)
+    def _cs(bs, cond, *args, **kwargs):
+        return create_scatterplot(cond, *args, bs=bs, **kwargs)
 
     if keep_frac is None:
         keep_frac = 0.2
@@ -482,11 +907,12 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
 
     if subsample == 'uniform':
         cb_kwargs = {'steps': steps}
-    elif subsample == 'density':
+    elif subsample in ('density', 'lod'):
         cb_kwargs = {'size': int(keep_frac * adata.n_obs), 'seed': seed}
     else:
         cb_kwargs = {}
     alazy = SamplingLazyDict(adata, subsample, callback_kwargs=cb_kwargs)
+    aggregates = AggregationCache()
 
     if obs_keys is None:
         obs_keys = skip_or_filter(adata, adata.obs.keys(), adata.obs.keys(),
@@ -541,6 +967,10 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
         assert f'X_{bs}' in adata.obsm.keys(), f'`X_{bs}` not found in `adata.obsm`'
         assert shape[-1] > np.max(comp), f'Requested invalid components `{list(comp)}` for basis `X_{bs}` with shape `{shape}`.'
 
+    if prefetch:
+        alazy.prefetch(component_pairs(adata, basis, components),
+                       n_jobs=None if isinstance(prefetch, bool) else prefetch)
+
     if adata.n_obs > SUBSAMPLE_THRESH and subsample in NO_SUBSAMPLE:
         warnings.warn(f'Number of cells `{adata.n_obs}` > `{SUBSAMPLE_THRESH}`. Consider specifying `subsample={SUBSAMPLING_STRATEGIES}`.')
 
@@ -575,7 +1005,11 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
 
     if not lazy_loading:
         # have to wrap because of the *args
-        dynmaps = [hv.HoloMap({(c, b):create_scatterplot(c, bs=b) for c in conditions for b in basis}, kdims=kdims[::-1])]
+        keys = [(c, b) for c in conditions for b in basis]
+        # HoloViews options aren't thread-safe, the workers only prepare the data
+        data = parallel_map(lambda c, b: _scatter_data(c, bs=b), keys, n_jobs=n_jobs, progress=progress)
+        plots = [_scatter_element(*d) for d in data]
+        dynmaps = [hv.HoloMap(dict(zip(keys, plots)), kdims=kdims[::-1])]
     else:
         for bs, comp in zip(basis, components):
             kdims.append(hv.Dimension(f'{bs.upper()}[X]',
@@ -585,16 +1019,18 @@ def scatterc(adata, basis=None, components=[1, 2], obs_keys=None,
                                       type=int, default=2, step=1,
                                       range=(1, adata.obsm[f'X_{bs}'].shape[-1])))
 
+        # refine the sample when the viewport changes
+        streams = lambda: [hv.streams.RangeXY(transient=True)] if subsample == 'lod' else []
         if cols is None:
-            dynmaps = [hv.DynamicMap(_cs, kdims=kdims)]
+            dynmaps = [hv.DynamicMap(_cs, kdims=kdims, streams=streams())]
         else:
-            dynmaps = [hv.DynamicMap(partial(create_scatterplot, bs=bs), kdims=kdims[1:]) for bs in basis]
+            dynmaps = [hv.DynamicMap(partial(create_scatterplot, bs=bs), kdims=kdims[1:], streams=streams()) for bs in basis]
 
     legend = None
     if subsample == 'datashade':
-        subsampled = [dynspread(datashade(d, aggregator=ds.count_cat('cond'), color_key=cmap,
+        subsampled = [dynspread(cached_datashade(d, aggregator=ds.count_cat('cond'), color_key=cmap, tiles=tiles,
                                           streams=[hv.streams.RangeXY(transient=True), hv.streams.PlotSize],
-                                          min_alpha=255).opts(axiswise=True, framewise=True), threshold=0.8, max_px=5)
+                                          min_alpha=255, cache=aggregates).opts(axiswise=True, framewise=True), threshold=0.8, max_px=5)
                       for d in dynmaps]
         dynmaps = add_hover(subsampled, dynmaps) if hover else subsampled
 
@@ -637,7 +1073,7 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         sort=True, skip=True, seed=None, show_legend=True, root_cell_all=False,
         root_cell_hl=True, root_cell_bbox=True, root_cell_size=None, root_cell_color='orange',
         legend_loc='top_right', size=4, perc=None, show_perc=True, cat_cmap=None, cont_cmap=None,
-        plot_height=400, plot_width=400, *args, **kwargs):
+        plot_height=400, plot_width=400, *args, prefetch=False, client_side=False, root_cell_tap=False, **kwargs):
     '''
     Scatter plot for categorical observations.
 
@@ -661,15 +1097,16 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         use `adata.raw` for gene expression levels
     subsample: Str, optional (default: `'datashade'`)
         subsampling strategy for large data
-        possible values are `None, 'none', 'datashade', 'decimate', 'density', 'uniform'`
+        possible values are `None, 'none', 'datashade', 'decimate', 'density', 'uniform', 'lod'`
         using `subsample='datashade'` is preferred over other options since it does not subset
         when using `subsample='datashade'`, colorbar is not visible
         `'density'` and `'uniform'` use first element of `basis` for their computation
+        `'lod'` shows more cells when zooming in, up to `keep_frac * adata.n_obs` per frame
     steps: Union[Int, Tuple[Int, Int]], optional (default: `40`)
         step size when the embedding directions
         larger step size corresponds to higher density of points
     keep_frac: Float, optional (default: `adata.n_obs / 5`)
-        number of observations to keep when `subsample='decimate'`
+        number of observations to keep when `subsample='decimate'`, `'density'` or `'lod'`
     sort: Bool, optional (default: `True`)
         whether sort the `genes`, `obs_keys` and `obsm_keys`
         in ascending order
@@ -717,6 +1154,17 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         width of the plot in pixels
     *args, **kwargs:
         additional arguments for `sc.tl.dpt`
+    prefetch: Union[Bool, Int], optional (default: `False`)
+        whether to compute the samples for all basis and their adjacent components
+        in the background, used when `subsample='uniform'`, `'density'` or `'lod'`
+        if integer, it specifies the number of threads
+    client_side: Bool, optional (default: `False`)
+        whether to change the percentiles and the continuous colormap in the browser,
+        without sending the data again
+        when `subsample='datashade'`, continuous values are rasterized and colormapped in the browser
+    root_cell_tap: Bool, optional (default: `False`)
+        select the root cell by clicking on the pseudotime embedding instead of using a widget,
+        the closest root cell in the currently shown basis is selected
 
     Returns
     --------
@@ -724,43 +1172,79 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         holoviews plot wrapped in `panel.Column`
     '''
 
-    def create_scatterplot(root_cell, gene, bs, perc_low, perc_high, *args, typp='expr', ret_hl=False):
+    def create_scatterplot(root_cell, gene, bs, perc_low, perc_high, *args, typp='expr', x_range=None, y_range=None):
+        if perc_low is not None and perc_high is not None:
+            if perc_low > perc_high:
+                perc_low, perc_high = perc_high, perc_low
+            perc = [perc_low, perc_high]
+        else:
+            perc = None
+
+        # when only the percentiles change, the same element is returned with new color limits
+        # elements which don't depend on the root cell or the gene are shared
+        deps = {'emb_discrete': (), 'expr': (root_cell, gene)}.get(typp, (root_cell, ))
+        if typp == 'emb':
+            # needed to find the tapped cell
+            shown.update(bs=bs, args=args)
+        elem_key = (typp, bs, args, x_range, y_range) + deps
+        try:
+            element, quantiles = elements[elem_key]
+        except KeyError:
+            element, quantiles = elements[elem_key] = _create_scatterplot(root_cell, gene, bs, *args, typp=typp,
+                                                                          x_range=x_range, y_range=y_range)
+
+        if quantiles is None or subsample == 'datashade':
+            return element
+
+        if controls is not None:
+            return controls.link(element, quantiles)
+
+        return element.opts(clim=quantiles(perc), clone=False)
+
+    def get_components(bs, *args):
         ixs = np.where(basis == bs)[0][0]
         is_diffmap = bs == 'diffmap'
 
         if len(args) > 0:
             ixs = np.where(basis == bs)[0][0] * 2
-            comp = (np.array([args[ixs], args[ixs + 1]]) - (not is_diffmap)) % adata.obsm[f'X_{bs}'].shape[-1]
-        else:
-            comp = np.array(components[ixs])  # need to make a copy
+            return (np.array([args[ixs], args[ixs + 1]]) - (not is_diffmap)) % adata.obsm[f'X_{bs}'].shape[-1]
 
-        ad, _ = alazy[bs, tuple(comp)]
-        ad_mraw = ad.raw if use_raw else ad
+        return np.array(components[ixs])  # need to make a copy
 
-        if perc_low is not None and perc_high is not None:
-            if perc_low > perc_high:
-                perc_low, perc_high = perc_high, perc_low
-            perc = [perc_low, perc_high]
-        else:
-            perc = None
+    def select_root_cell(x, y):
+        if x is None or y is None:
+            return
+
+        bs = shown['bs']
+        scale = 1000 if bs == 'diffmap' else 1
+        ix = nearest_obs(adata, bs, get_components(bs, *shown['args']), x / scale, y / scale, ixs=root_ixs)
+        root_stream.event(root_cell=adata.obs_names[ix])
+
+    def _create_scatterplot(root_cell, gene, bs, *args, typp='expr', x_range=None, y_range=None):
+        is_diffmap = bs == 'diffmap'
+        comp = get_components(bs, *args)
+
+        ad, ad_ixs = alazy.query((bs, tuple(comp)), x_range, y_range, scale=1000 if is_diffmap else 1)
+        # not the extent of `points`, it's only the viewport in the `'lod'` mode
+        (xmin, xmax), (ymin, ymax) = alazy.limits((bs, tuple(comp)), scale=1000 if is_diffmap else 1)
+        ad_mraw = ad.raw if use_raw else ad
 
         # because diffmap has small range, it iterferes with
         # the legend created
-        emb = ad.obsm[f'X_{bs}'][:, comp] * (1000 if is_diffmap else 1)
+        points = ad.points(bs, comp, scale=1000 if is_diffmap else 1)
         comp += not is_diffmap  # naming consistence
 
         bsu = bs.upper()
         x = hv.Dimension('x', label=f'{bsu}{comp[0]}')
         y = hv.Dimension('y', label=f'{bsu}{comp[1]}')
-        xmin, xmax = minmax(emb[:, 0])
-        ymin, ymax = minmax(emb[:, 1])
 
         # adata is the original, ad may be subsampled
-        mask = np.in1d(adata.obs_names, ad.obs_names)
+        mask = ad_ixs
 
         if typp == 'emb_discrete':
-            scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'condition': data[mask]},
-                                 kdims=[x, y], vdims='condition').sort('condition')
+            points['condition'] = data[mask]
+            scatter = hv.Scatter(points, kdims=[x, y], vdims='condition').sort('condition')
+            set_aggregate_key(scatter, key, bs, tuple(comp))
 
             scatter = scatter.opts(title=key,
                                    color='condition',
@@ -772,52 +1256,49 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
 
             if is_cat:
                 # we're manually creating legend (for datashade)
-                return scatter.opts(cmap=cat_cmap, show_legend=False)
+                return scatter.opts(cmap=cat_cmap, show_legend=False), None
 
-            return scatter.opts(colorbar=True, colorbar_opts={'width': CBW},
-                                cmap=cont_cmap, clim=minmax(data, perc=perc))
+            return scatter.opts(colorbar=True, colorbar_opts={'width': CBW}, cmap=cont_cmap), data_quantiles
 
 
         if typp == 'root_cell_hl':
             # find the index of the root cell in maybe subsampled data
             rid = np.where(ad.obs_names == root_cell)[0]
             if not len(rid):
-                return hv.Scatter([]).opts(axiswise=True, framewise=True)
+                return hv.Scatter([]).opts(axiswise=True, framewise=True), None
 
             rid = rid[0]
             dx, dy = (xmax - xmin) / 25, (ymax - ymin) / 25
-            rx, ry = emb[rid, 0], emb[rid, 1]
+            rx, ry = points['x'].values[rid], points['y'].values[rid]
 
-            root_cell_scatter = hv.Scatter({'x': emb[rid, 0], 'y': emb[rid, 1]}).opts(color=root_cell_color, size=root_cell_size)
+            root_cell_scatter = hv.Scatter({'x': rx, 'y': ry}).opts(color=root_cell_color, size=root_cell_size)
             if root_cell_bbox:
                 root_cell_scatter *= hv.Bounds((rx - dx, ry - dy, rx + dx, ry + dy)).opts(line_width=4, color=root_cell_color).opts(axiswise=True, framewise=True)
 
-            return root_cell_scatter
+            return root_cell_scatter, None
 
 
-        adata.uns['iroot'] = np.where(adata.obs_names == root_cell)[0][0]
-        dpt_fn(adata, *args, **kwargs)
-
-        pseudotime = adata.obs['dpt_pseudotime'].values
-        pseudotime = pseudotime[mask]
+        pseudotime = _pseudotime(adata, root_cell, *args, **kwargs)[mask]
         pseudotime[pseudotime == np.inf] = 1
         pseudotime[pseudotime == -np.inf] = 0
 
         if typp == 'emb':
 
-            scatter = hv.Scatter({'x': emb[:, 0], 'y': emb[:, 1], 'pseudotime': pseudotime},
-                                 kdims=[x, y], vdims='pseudotime')
+            points['pseudotime'] = pseudotime
+            scatter = hv.Scatter(points, kdims=[x, y], vdims='pseudotime')
+            set_aggregate_key(scatter, 'pseudotime', root_cell, bs, tuple(comp))
 
-            return scatter.opts(title='Pseudotime',
-                                cmap=cont_cmap, color='pseudotime',
-                                colorbar=True,
-                                colorbar_opts={'width': CBW},
-                                size=size,
-                                clim=minmax(pseudotime, perc=perc),
-                                xlim=(xmin, xmax),
-                                ylim=(ymin, ymax),
-                                xlabel=f'{bsu}{comp[0]}',
-                                ylabel=f'{bsu}{comp[1]}')# if not ret_hl else root_cell_scatter
+            scatter = scatter.opts(title='Pseudotime',
+                                   cmap=cont_cmap, color='pseudotime',
+                                   colorbar=True,
+                                   colorbar_opts={'width': CBW},
+                                   size=size,
+                                   xlim=(xmin, xmax),
+                                   ylim=(ymin, ymax),
+                                   xlabel=f'{bsu}{comp[0]}',
+                                   ylabel=f'{bsu}{comp[1]}')
+
+            return scatter, Quantiles(pseudotime)
 
         if typp == 'expr':
             expr = ad_mraw.obs_vector(gene)
@@ -827,6 +1308,7 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
             # data is in outer scope
             scatter_expr = hv.Scatter({'x': pseudotime, 'y': expr, 'condition': data[mask]},
                                       kdims=[x, y], vdims='condition')
+            set_aggregate_key(scatter_expr, key, root_cell, gene, bs)
 
             scatter_expr = scatter_expr.opts(title=key,
                                              color='condition',
@@ -835,17 +1317,16 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
                                              ylim=minmax(expr))
             if is_cat:
                 # we're manually creating legend (for datashade)
-                return scatter_expr.opts(cmap=cat_cmap, show_legend=False)
+                return scatter_expr.opts(cmap=cat_cmap, show_legend=False), None
 
-            return scatter_expr.opts(colorbar=True, colorbar_opts={'width': CBW},
-                                     cmap=cont_cmap, clim=minmax(data, perc=perc))
+            return scatter_expr.opts(colorbar=True, colorbar_opts={'width': CBW}, cmap=cont_cmap), data_quantiles
 
         if typp == 'hist':
             return hv.Histogram(np.histogram(pseudotime, bins=20)).opts(xlabel='pseudotime',
                                                                         ylabel='frequency',
-                                                                        color='#f2f2f2')
+                                                                        color='#f2f2f2'), None
 
-        raise RuntimeError(f'Unknown type `{typp}` for `create_scatterplot`.')
+        raise RuntimeError(f'Unknown type `{typp}` for `_create_scatterplot`.')
 
     # we copy beforehand
     if kwargs.pop('copy', False):
@@ -875,11 +1356,13 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
 
     if subsample == 'uniform':
         cb_kwargs = {'steps': steps}
-    elif subsample == 'density':
+    elif subsample in ('density', 'lod'):
         cb_kwargs = {'size': int(keep_frac * adata.n_obs), 'seed': seed}
     else:
         cb_kwargs = {}
     alazy = SamplingLazyDict(adata, subsample, callback_kwargs=cb_kwargs)
+    elements = LRUCache(max_entries=ELEMENT_CACHE_MAX_ENTRIES)
+    aggregates = AggregationCache()
     adata_mraw = adata.raw if use_raw else adata
 
     if genes is None:
@@ -918,6 +1401,10 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
         assert f'X_{bs}' in adata.obsm.keys(), f'`X_{bs}` not found in `adata.obsm`'
         assert shape[-1] > np.max(comp), f'Requested invalid components `{list(comp)}` for basis `X_{bs}` with shape `{shape}`.'
 
+    if prefetch:
+        alazy.prefetch(component_pairs(adata, basis, components),
+                       n_jobs=None if isinstance(prefetch, bool) else prefetch)
+
     if adata.n_obs > SUBSAMPLE_THRESH and subsample in NO_SUBSAMPLE:
         warnings.warn(f'Number of cells `{adata.n_obs}` > `{SUBSAMPLE_THRESH}`. Consider specifying `subsample={SUBSAMPLING_STRATEGIES}`.')
 
@@ -927,10 +1414,15 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
     if cont_cmap is None:
         cont_cmap = Viridis256
 
-    kdims = [hv.Dimension('Root cell', values=(adata if root_cell_all else alazy[basis[0], tuple(components[0])][0]).obs_names),
+    root_ad, root_ixs = (adata, None) if root_cell_all else alazy[basis[0], tuple(components[0])]
+    root_cells = root_ad.obs_names
+    shown = {'bs': basis[0], 'args': ()}
+    kdims = [hv.Dimension('Root cell', values=root_cells),
              hv.Dimension('Gene', values=genes),
              hv.Dimension('Basis', values=basis)]
     cs = lambda cell, gene, bs, *args, **kwargs: create_scatterplot(cell, gene, bs, perc[0], perc[1], *args, **kwargs)
+    # percentiles are changed in the browser
+    controls = ColorControls(perc, cont_cmap, show_perc=show_perc) if client_side else None
 
     data, is_cat = get_data(adata, key)
     if is_cat:
@@ -941,39 +1433,79 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
                                for c, color in zip(data.categories, cat_cmap)})
     else:
         data = np.array(data, dtype=np.float64)
+        data_quantiles = Quantiles(data)
         aggregator = ds.mean
         cmap = cont_cmap
         legend = None
-        if show_perc and subsample != 'datashade':
+        if show_perc and subsample != 'datashade' and controls is None:
             kdims += [
                 hv.Dimension('Percentile (lower)', range=(0, 100), step=0.1, type=float, default=0 if perc[0] is None else perc[0]),
                 hv.Dimension('Percentile (upper)', range=(0, 100), step=0.1, type=float, default=100 if perc[1] is None else perc[1])
             ]
             cs = create_scatterplot
 
-    emb = hv.DynamicMap(partial(cs, typp='emb'), kdims=kdims)
+    # too many values for a dropdown, they're supplied by a stream
+    pickers = odict()
+    if len(genes) > SEARCH_THRESH:
+        pickers['gene'] = ConditionPicker('Gene', genes)
+        kdims.pop(1)
+        cs = kwarg_as_arg(cs, 1, 'gene')
+    root_stream = None
+    if root_cell_tap:
+        # only the tapped position is sent, the cell is found on the server
+        root_stream = hv.streams.Stream.define('RootCell', root_cell=root_cells[0])()
+        kdims.pop(0)
+        cs = kwarg_as_arg(cs, 0, 'root_cell')
+    elif len(root_cells) > SEARCH_THRESH:
+        pickers['root_cell'] = ConditionPicker('Root cell', root_cells)
+        kdims.pop(0)
+        cs = kwarg_as_arg(cs, 0, 'root_cell')
+
+    # refine the sample of the embeddings when the viewport changes
+    streams = lambda lod=True: ([hv.streams.RangeXY(transient=True)] if lod and subsample == 'lod' else []) + \
+                               [_picker_stream(p, n) for n, p in pickers.items()] + \
+                               ([] if root_stream is None else [root_stream])
+    emb = hv.DynamicMap(partial(cs, typp='emb'), kdims=kdims, streams=streams())
     if root_cell_hl:
-        root_cell = hv.DynamicMap(partial(cs, typp='root_cell_hl'), kdims=kdims)
-    emb_d = hv.DynamicMap(partial(cs, typp='emb_discrete'), kdims=kdims)
-    expr = hv.DynamicMap(partial(cs, typp='expr'), kdims=kdims)
-    hist = hv.DynamicMap(partial(cs, typp='hist'), kdims=kdims)
-
-    if subsample == 'datashade':
-        emb = dynspread(datashade(emb, aggregator=ds.mean('pseudotime'), cmap=cont_cmap,
+        root_cell = hv.DynamicMap(partial(cs, typp='root_cell_hl'), kdims=kdims, streams=streams())
+    emb_d = hv.DynamicMap(partial(cs, typp='emb_discrete'), kdims=kdims, streams=streams())
+    expr = hv.DynamicMap(partial(cs, typp='expr'), kdims=kdims, streams=streams(lod=False))
+    hist = hv.DynamicMap(partial(cs, typp='hist'), kdims=kdims, streams=streams(lod=False))
+
+    if subsample == 'datashade' and controls is not None:
+        def rasterize_or_shade(d, agg):
+            streams = [hv.streams.RangeXY(transient=True), hv.streams.PlotSize]
+            if isinstance(agg, ds.count_cat):
+                # categorical values are still shaded on the server
+                return dynspread(cached_datashade(d, aggregator=agg, cmap=cmap, streams=streams, min_alpha=255,
+                                                  cache=aggregates),
+                                 threshold=0.8, max_px=5)
+
+            return cached_rasterize(d, aggregator=agg, streams=streams, cache=aggregates)\
+                .opts(cmap=cont_cmap, colorbar=True, colorbar_opts={'width': CBW})
+
+        emb = rasterize_or_shade(emb, ds.mean('pseudotime'))
+        emb_d = rasterize_or_shade(emb_d, aggregator('condition'))
+        expr = rasterize_or_shade(expr, aggregator('condition'))
+    elif subsample == 'datashade':
+        emb = dynspread(cached_datashade(emb, aggregator=ds.mean('pseudotime'), cmap=cont_cmap, cache=aggregates,
                                   streams=[hv.streams.RangeXY(transient=True), hv.streams.PlotSize],
                                   min_alpha=255),
                         threshold=0.8, max_px=5)
-        emb_d = dynspread(datashade(emb_d, aggregator=aggregator('condition'), cmap=cmap,
+        emb_d = dynspread(cached_datashade(emb_d, aggregator=aggregator('condition'), cmap=cmap, cache=aggregates,
                                     streams=[hv.streams.RangeXY(transient=True), hv.streams.PlotSize],
                                     min_alpha=255),
                         threshold=0.8, max_px=5)
-        expr = dynspread(datashade(expr, aggregator=aggregator('condition'), cmap=cmap,
+        expr = dynspread(cached_datashade(expr, aggregator=aggregator('condition'), cmap=cmap, cache=aggregates,
                                    streams=[hv.streams.RangeXY(transient=True), hv.streams.PlotSize],
                                    min_alpha=255),
                         threshold=0.8, max_px=5)
     elif subsample == 'decimate':
         emb, emb_d, expr = (decimate(d, max_samples=int(adata.n_obs * keep_frac)) for d in (emb, emb_d, expr))
 
+    if controls is not None:
+        emb, emb_d, expr = (d.opts(hooks=[controls.hook]) for d in (emb, emb_d, expr))
+
     if root_cell_hl:
         emb *= root_cell  # emb * root_cell.opts(axiswise=True, framewise=True)
 
@@ -982,10 +1514,18 @@ def dpt(adata, key, genes=None, basis=None, components=[1, 2],
     emb_d = emb_d.opts(axiswise=True, framewise=True, frame_height=plot_height, frame_width=plot_width)
     hist = hist.opts(axiswise=True, framewise=True, frame_height=plot_height, frame_width=plot_width)
 
+    if root_stream is not None:
+        hv.streams.Tap(source=emb).add_subscriber(select_root_cell)
+
     if show_legend and legend is not None:
         emb_d = (emb_d * legend).opts(legend_position=legend_loc, show_legend=True)
 
-    return ((emb + emb_d)  + (hist + expr).opts(axiswise=True, framewise=True)).cols(2)
+    plot = ((emb + emb_d)  + (hist + expr).opts(axiswise=True, framewise=True)).cols(2)
+    widgets = [p.widget for p in pickers.values()] + ([] if controls is None else controls.widgets)
+    if len(widgets):
+        return plot, widgets
+
+    return plot
 
 
 @wrap_as_col
@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from collections import Iterable
+from collections import OrderedDict as odict, namedtuple
+from collections.abc import Mapping, MutableMapping
 from inspect import signature
-from sklearn.neighbors import NearestNeighbors
 from scipy.sparse import issparse
+from scipy.sparse.csgraph import connected_components
+from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
 
 import anndata
 import matplotlib.colors as colors
-import scanpy as sc
+import matplotlib.cm as cm
 import numpy as np
 import pandas as pd
 import networkx as nx
@@ -16,16 +21,57 @@ import panel as pn
 import re
 import itertools
 import warnings
+import threading
+import weakref
+import hashlib
+import os
 
 
 NO_SUBSAMPLE = (None, 'none')
-SUBSAMPLING_STRATEGIES = ('datashade', 'decimate', 'density', 'uniform')
+SUBSAMPLING_STRATEGIES = ('datashade', 'decimate', 'density', 'uniform', 'lod')
 ALL_SUBSAMPLING_STRATEGIES = NO_SUBSAMPLE + SUBSAMPLING_STRATEGIES
 
 SUBSAMPLE_THRESH = 30_000
 HOLOMAP_THRESH = 50
+SEARCH_THRESH = 1_000
+SEARCH_TOP_N = 100
 OBSM_SEP = ':'
 
+SAMPLING_CACHE_MAX_ENTRIES = 64
+SAMPLING_CACHE_MAX_BYTES = 512 * 1024 ** 2
+POINTS_CACHE_MAX_ENTRIES = 4
+DENSITY_CACHE_MAX_ENTRIES = 32
+DENSITY_GRID_SIZE = 256
+LOD_MAX_LEVEL = 16
+CACHE_DIR_NAME = '.interactive_plotting_cache'
+COLUMN_CACHE_MAX_BYTES = 256 * 1024 ** 2
+COLUMN_ACCESSORS_MAX_ENTRIES = 4
+COLUMN_ACCESSORS_MAX_BYTES = 2 * 1024 ** 3
+KEY_INDICES_MAX_ENTRIES = 8
+PALETTE_SIZE = 256
+PALETTE_CACHE_MAX_ENTRIES = 64
+FINGERPRINT_N_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64
+AGGREGATE_CACHE_MAX_ENTRIES = 256
+AGGREGATE_CACHE_MAX_BYTES = 256 * 1024 ** 2
+RANGE_QUANTIZATION_DIGITS = 3
+TILE_SIZE = 256
+TILE_MAX_LEVELS = 8
+PYRAMID_CACHE_MAX_BYTES = 1024 ** 3
+QUANTILES_SIZE = 1001
+CLIENT_CMAPS = ('viridis', 'plasma', 'inferno', 'magma', 'cividis', 'Greys')
+ELEMENT_CACHE_MAX_ENTRIES = 32
+CATEGORY_CODES_MAX_ENTRIES = 64
+PIXEL_INDEX_CACHE_MAX_ENTRIES = 16
+PSEUDOTIME_CACHE_MAX_ENTRIES = 32
+DPT_N_DCS = 10
+DPT_EVAL_THRESH = 0.9994
+DPT_CHUNK_SIZE = 1024
+# number of differences of coordinates computed at once for a batch of roots
+DPT_BLOCK_SIZE = 2 ** 22
+DPT_CACHE_MAX_ENTRIES = 4
+KD_TREE_CACHE_MAX_ENTRIES = 16
+
 CBW = 10  # colorbar width
 BS_PAT = re.compile('^X_(.+)')
 
@@ -37,507 +83,3289 @@ DEFAULT_LAYOUTS.pop('rescale')
 DEFAULT_LAYOUTS.pop('spectral')
 
 
-class SamplingLazyDict(dict):
+class _LazyColumns(Mapping):
+    '''
+    Read-only mapping which subsets the values of its parent on access.
+    '''
+
+    def __init__(self, parent, take):
+        self._parent = parent
+        self._take = take
+
+    def __getitem__(self, key):
+        return self._take(self._parent[key])
+
+    def __contains__(self, key):
+        return key in self._parent
+
+    def __iter__(self):
+        return iter(self._parent.keys())
+
+    def __len__(self):
+        return len(self._parent.keys())
+
+    def keys(self):
+        return self._parent.keys()
+
+
+class SampledView:
+    '''
+    Lightweight view of subsampled `anndata.AnnData`.
+
+    Only the indices of the sampled observations are stored,
+    the values (embeddings, observations, gene expression)
+    are read from the parent object on demand.
+
+    Params
+    --------
+    adata: Union[anndata.AnnData, anndata.Raw]
+        parent object
+    ixs: np.ndarray, optional (default: `None`)
+        indices of the sampled observations,
+        if `None`, use all of them
+    '''
 
-    def __init__(self, adata, subsample, *args, callback_kwargs={}, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, adata, ixs=None):
         self.adata = adata
-        self.callback_kwargs = callback_kwargs
+        self.is_full = ixs is None
+        self.ixs = np.arange(adata.n_obs) if self.is_full else np.asarray(ixs, dtype=np.int64)
+        self._points = LRUCache(max_entries=POINTS_CACHE_MAX_ENTRIES)
+        self._codes = LRUCache(max_entries=CATEGORY_CODES_MAX_ENTRIES)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(n_obs={self.n_obs}, parent_n_obs={self.adata.n_obs})'
+
+    @property
+    def n_obs(self):
+        return len(self.ixs)
+
+    @property
+    def n_vars(self):
+        return self.adata.n_vars
+
+    @property
+    def shape(self):
+        return self.n_obs, self.n_vars
+
+    @property
+    def nbytes(self):
+        return self.ixs.nbytes + get_nbytes(self._points) + get_nbytes(self._codes)
+
+    @property
+    def obs_names(self):
+        return self.take(self.adata.obs_names)
+
+    @property
+    def var_names(self):
+        return self.adata.var_names
+
+    @property
+    def obs(self):
+        return _LazyColumns(self.adata.obs, self.take)
+
+    @property
+    def obsm(self):
+        return _LazyColumns(self.adata.obsm, self.take)
+
+    @property
+    def raw(self):
+        raw = getattr(self.adata, 'raw', None)
+        if raw is None:
+            return None
 
-        if subsample == 'uniform':
-            self.callback = sample_unif
-        elif subsample == 'density':
-            self.callback = sample_density
-        else:
-            ixs = list(range(adata.n_obs))
-            self.callback = lambda *args, **kwargs: (adata, ixs)
+        return SampledView(raw, None if self.is_full else self.ixs)
 
-    def __getitem__(self, key):
-        if key not in self:
-            bs, comps = key
-            rev_comps = comps[::-1]
+    def obs_keys(self):
+        return self.adata.obs_keys()
 
-            if (bs, rev_comps) in self.keys():
-                res, ixs = self[bs, rev_comps]
-            else:
-                res, ixs = self.callback(self.adata, bs=bs, components=comps, **self.callback_kwargs)
+    def obs_vector(self, k, layer=None):
+        if k in self.adata.var_names:
+            return self.take(gene_vector(self.adata, k, layer=layer))
 
-            self[key] = res, ixs
+        if layer is None:
+            return self.take(self.adata.obs_vector(k))
 
-            return res, ixs
+        return self.take(self.adata.obs_vector(k, layer=layer))
 
-        return super().__getitem__(key)
+    def points(self, bs, components, scale=1, order=None, **values):
+        '''
+        Get a table of the coordinates of the sampled observations and their values.
 
+        The coordinates are computed once per basis, components and draw order, only the tables of
+        few most recently used ones are kept. Each returned table shares them without copying
+        and only adds the values as new columns.
 
-def to_hex_palette(palette, normalize=True):
-    """
-    Converts matplotlib color array to hex strings
-    """
-    if not isinstance(palette, np.ndarray):
-        palette = np.array(palette)
+        Params
+        --------
+        bs: Str
+            basis in `adata.obsm`
+        components: Tuple[Int, Int]
+            components of the basis
+        scale: Float, optional (default: `1`)
+            factor by which to multiply the coordinates
+        order: np.ndarray, optional (default: `None`)
+            order in which to draw the observations, e.g. `CategoryCodes.order`,
+            should be the same object for the same order
+        **values: Dict[Str, Union[np.ndarray, pd.Categorical]]
+            columns to add to the table, in the order of the observations
 
-    if isinstance(palette[0], str):
-        assert all(map(colors.is_color_like, palette)), 'Not all strings are color like.'
-        return palette
+        Returns
+        --------
+        table: pd.DataFrame
+            coordinates in columns `'x'` and `'y'` followed by the values
+        '''
 
-    if normalize:
-        minn = np.min(palette)
-        # normalize to [0, 1]
-        palette = (palette - minn) / (np.max(palette) - minn)
+        key = (bs, tuple(map(int, components)), scale)
+        token = fingerprint(self.adata.obsm[f'X_{bs}'])
+
+        cached_token, table = self._points.get(key, (None, None))
+        if cached_token != token:
+            emb = self.adata.obsm[f'X_{bs}']
+            table = pd.DataFrame({'x': np.asarray(self.take(emb[:, key[1][0]]), dtype=np.float64) * scale,
+                                  'y': np.asarray(self.take(emb[:, key[1][1]]), dtype=np.float64) * scale})
+            self._points[key] = (token, table)
+
+        if order is not None:
+            # the coordinates are reordered once per order, not on every call
+            ordered_key = key + (fingerprint(order), )
+            cached_token, ordered = self._points.get(ordered_key, (None, None))
+            if cached_token != token:
+                ordered = table.iloc[order]
+                self._points[ordered_key] = (token, ordered)
+            table = ordered
+            values = {k: v[order] for k, v in values.items()}
+
+        table = table.copy(deep=False)
+        for k, v in values.items():
+            table[k] = v
+
+        return table
+
+    def codes(self, key, ix=None):
+        '''
+        Get the category codes and the draw order of the sampled observations.
 
-    return [colors.to_hex(c) if colors.is_color_like(c) else c for c in palette]
+        They are computed once per key, only few most recently used keys are kept,
+        and recomputed only when the parent's values change.
 
+        Params
+        --------
+        key: Str
+            key in `adata.obs` or, if `ix` is not `None`, in `adata.obsm`
+        ix: Int, optional (default: `None`)
+            column of `adata.obsm[key]`
 
-def pad(minn, maxx, padding=0.05):
-    if minn > maxx:
-        maxx, minn = minn, maxx
-    return minn - padding, maxx + padding
+        Returns
+        --------
+        codes: CategoryCodes
+            codes of the sampled values
+        '''
 
+        values = self.adata.obs[key] if ix is None else obsm_column(self.adata.obsm[key], ix)
+        token = fingerprint(values)
 
-def iterable(obj):
+        cached_token, codes = self._codes.get((key, ix), (None, None))
+        if cached_token != token:
+            codes = CategoryCodes(self.take(values), ordered=True)
+            self._codes[key, ix] = (token, codes)
+
+        return codes
+
+    def take(self, obj):
+        '''
+        Subset the observations of an object.
+
+        Params
+        --------
+        obj: Union[np.ndarray, pd.Series, pd.DataFrame, pd.Index]
+            object whose first dimension corresponds to observations
+
+        Returns
+        --------
+        subset: Union[np.ndarray, pd.Series, pd.DataFrame, pd.Index]
+            the subsetted object or the object itself if nothing was sampled
+        '''
+
+        if self.is_full:
+            return obj
+
+        if isinstance(obj, (pd.Series, pd.DataFrame)):
+            return obj.iloc[self.ixs]
+
+        return obj[self.ixs]
+
+    def to_adata(self, copy=True):
+        '''
+        Create `anndata.AnnData` containing only the sampled observations.
+
+        Params
+        --------
+        copy: Bool, optional (default: `True`)
+            whether to return an actual copy instead of an `anndata` view
+
+        Returns
+        --------
+        adata: anndata.AnnData
+            the subsampled object
+        '''
+
+        adata = self.adata if self.is_full else self.adata[self.ixs, :]
+
+        return adata.copy() if copy else adata
+
+
+class LODView(SampledView):
     '''
-    Checks whether the object is iterable non-string.
-    
+    `SampledView` backed by a quadtree of representative cells.
+
+    The cells are ordered by the coarsest level of the quadtree at which
+    they represent a quadtree cell. The view itself contains the first `size`
+    cells, viewport queries return up to `size` cells inside the viewport,
+    which get progressively finer as the viewport shrinks.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        parent object
+    order: np.ndarray
+        indices of all the cells, from coarsest to finest level
+    offsets: np.ndarray
+        cumulative number of cells up to and including each level
+    coords: np.ndarray
+        embedding of the cells in `order`
+    size: Int
+        maximum number of cells per query
+    levels: np.ndarray
+        level of the quadtree cells used to index each group of `offsets`
+
+    Within each level, the cells are also sorted by the row-major key of their quadtree cell,
+    so that a viewport query only reads the cells covering the viewport.
+    '''
+
+    def __init__(self, adata, order, offsets, coords, size, levels):
+        super().__init__(adata, np.sort(order[:size]))
+        self.order = order
+        self.offsets = offsets
+        self.coords = coords
+        self.size = size
+        self.levels = levels
+
+        self._min = np.min(coords, axis=0) if len(coords) else np.zeros(coords.shape[1])
+        self._span = (np.max(coords, axis=0) - self._min) if len(coords) else np.ones(coords.shape[1])
+        self._span[self._span == 0] = 1
+
+        # positions in `order`, sorted by the cell key within each level (stable, so by priority too)
+        self._keys = np.empty(len(order), dtype=np.int64)
+        self._perm = np.empty(len(order), dtype=np.int64)
+        start = 0
+        for end, level in zip(offsets, levels):
+            keys = self._cell_keys(coords[start:end], 2 ** int(level))
+            perm = np.argsort(keys, kind='stable')
+            self._keys[start:end] = keys[perm]
+            self._perm[start:end] = start + perm
+            start = end
+
+    @property
+    def nbytes(self):
+        return super().nbytes + self.order.nbytes + self.offsets.nbytes + self.coords.nbytes + \
+            self._keys.nbytes + self._perm.nbytes
+
+    def _cells(self, values, dim, k):
+        # same binning as `sample_lod`
+        scaled = (np.asarray(values, dtype=np.float64) - self._min[dim]) / self._span[dim]
+        return np.clip(np.floor(scaled * k), 0, k - 1).astype(np.int64)
+
+    def _cell_keys(self, coords, k):
+        rows = self._cells(coords[:, 0], 0, k)
+        cols = self._cells(coords[:, -1], coords.shape[1] - 1, k)
+        return rows * k + cols
+
+    def _candidates(self, start, end, k, x_range, y_range):
+        # sorted keys of the level, one contiguous run of cells per row of the viewport
+        last = self.coords.shape[1] - 1
+        r0, r1 = self._cells([-np.inf, np.inf] if x_range is None else x_range, 0, k)
+        c0, c1 = self._cells([-np.inf, np.inf] if y_range is None else y_range, last, k)
+
+        rows = np.arange(r0, r1 + 1, dtype=np.int64)
+        keys = self._keys[start:end]
+        lo = np.searchsorted(keys, rows * k + c0, side='left')
+        hi = np.searchsorted(keys, rows * k + c1, side='right')
+
+        lens = hi - lo
+        n = int(np.sum(lens))
+        if n == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # concatenate the ranges `[lo, hi)` without a python loop
+        nonempty = lens > 0
+        lo, lens = lo[nonempty], lens[nonempty]
+        steps = np.ones(n, dtype=np.int64)
+        steps[0] = lo[0]
+        heads = np.cumsum(lens)[:-1]
+        steps[heads] = lo[1:] - (lo[:-1] + lens[:-1] - 1)
+
+        return self._perm[start + np.cumsum(steps)]
+
+    def query(self, x_range=None, y_range=None):
+        '''
+        Get the cells inside the viewport.
+
+        Params
+        --------
+        x_range: Tuple[Float, Float], optional (default: `None`)
+            range of the first component, if `None`, it's unbounded
+        y_range: Tuple[Float, Float], optional (default: `None`)
+            range of the second component, if `None`, it's unbounded
+
+        Returns
+        --------
+        view: SampledView
+            at most `size` cells inside the viewport
+        '''
+
+        if x_range is None and y_range is None:
+            return self
+
+        last = self.coords.shape[1] - 1
+        found, n_found, start = [], 0, 0
+        for end, level in zip(self.offsets, self.levels):
+            ixs = self._candidates(start, end, 2 ** int(level), x_range, y_range)
+            start = end
+
+            # the cells on the border of the viewport are only partially covered
+            chunk = self.coords[ixs]
+            mask = np.ones(len(ixs), dtype=np.bool_)
+            for dim, rng in ((0, x_range), (last, y_range)):
+                if rng is not None:
+                    mask &= (chunk[:, dim] >= rng[0]) & (chunk[:, dim] <= rng[1])
+            ixs = ixs[mask]
+
+            if n_found + len(ixs) >= self.size:
+                # positions in `order` are by priority within a level
+                n_left = self.size - n_found
+                found.append(np.partition(ixs, n_left - 1)[:n_left] if n_left > 0 else ixs[:0])
+                break
+
+            found.append(ixs)
+            n_found += len(ixs)
+
+        ixs = np.concatenate(found) if len(found) else np.empty(0, dtype=np.int64)
+
+        return SampledView(self.adata, np.sort(self.order[ixs]))
+
+
+def get_nbytes(obj):
+    '''
+    Approximate the memory held by an object.
+
     Params
     --------
     obj: Object
-        Python object
+        Python object, such as `np.ndarray`, sparse matrix
+        or a collection of these
 
     Returns
     --------
-    is_iterable: Bool
-        whether the object is not `str` and is
-        instance of class `Iterable`
+    nbytes: Int
+        number of bytes of all the arrays in `obj`
     '''
 
-    return not isinstance(obj, str) and isinstance(obj, Iterable)
+    if obj is None:
+        return 0
 
+    if issparse(obj):
+        return sum(getattr(obj, attr).nbytes for attr in ('data', 'indices', 'indptr', 'row', 'col')
+                   if hasattr(obj, attr))
 
-def istype(obj):
-    '''
-    Checks whether the object is of class `type`.
+    if isinstance(obj, (tuple, list)):
+        return sum(map(get_nbytes, obj))
+
+    if isinstance(obj, dict):
+        return sum(map(get_nbytes, obj.values()))
+
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=False).sum())
+
+    if not hasattr(obj, 'nbytes') and hasattr(obj, 'data'):
+        # e.g. `holoviews` elements and overlays
+        return get_nbytes(obj.data)
+
+    nbytes = getattr(obj, 'nbytes', 0)
+
+    return int(nbytes) if isinstance(nbytes, (int, np.integer)) else 0
+
+
+def _sampled_block(arr, n_blocks, block_size):
+    if arr.ndim == 0 or arr.size <= n_blocks * block_size:
+        return arr
+
+    # contiguous blocks of rows spread across the array, few columns from each
+    ixs = []
+    for i, n in enumerate(arr.shape):
+        size = n_blocks * block_size if i == 0 else block_size
+        if n <= size:
+            ixs.append(np.arange(n))
+            continue
+        starts = np.linspace(0, n - block_size, min(n_blocks, size // block_size)).astype(np.int64)
+        ixs.append((starts[:, None] + np.arange(block_size)).ravel())
+
+    return arr[np.ix_(*ixs)]
+
+
+def _update_fingerprint(digest, obj, identity, n_blocks, block_size):
+    if issparse(obj):
+        digest.update(repr((type(obj).__name__, obj.shape, obj.nnz)).encode())
+        for attr in ('data', 'indices', 'indptr', 'row', 'col'):
+            if hasattr(obj, attr):
+                _update_fingerprint(digest, getattr(obj, attr), identity, n_blocks, block_size)
+        return
+
+    if isinstance(obj, pd.DataFrame):
+        _update_fingerprint(digest, obj.columns, identity, n_blocks, block_size)
+        for _, col in obj.items():
+            _update_fingerprint(digest, col, identity, n_blocks, block_size)
+        return
+
+    if isinstance(obj, (pd.Series, pd.Index)):
+        obj = obj.values
+
+    if isinstance(obj, pd.Categorical):
+        _update_fingerprint(digest, obj.categories, identity, n_blocks, block_size)
+        obj = obj.codes
+
+    if not isinstance(obj, np.ndarray):
+        # e.g. extension arrays, their buffer is materialized on each access
+        identity = False
+
+    obj = np.asarray(obj)
+    digest.update(repr((obj.shape, obj.dtype.str, obj.strides if identity else None)).encode())
+    if identity:
+        digest.update(repr(obj.__array_interface__['data'][0]).encode())
+
+    block = _sampled_block(obj, n_blocks, block_size)
+    if block.dtype.hasobject:
+        digest.update(pd.util.hash_array(block.ravel()).tobytes())
+    else:
+        digest.update(np.ascontiguousarray(block).view(np.uint8).ravel())
+
+
+def fingerprint(obj, identity=True, n_blocks=FINGERPRINT_N_BLOCKS, block_size=FINGERPRINT_BLOCK_SIZE):
+    f'''
+    Cheaply fingerprint an array-like object.
+
+    Only the shape, dtype, checksums of few strided blocks and optionally
+    the address of the underlying buffer are used, so the cost does not depend
+    on the size of the object. Changes outside the sampled blocks of an array
+    modified in place are not detected. Objects which are not backed by `np.ndarray`,
+    such as columns with pandas extension dtypes, are always fingerprinted by content.
 
     Params
     --------
-    obj: Union[Object, Tuple]
-        Python object or a tuple
+    obj: Union[np.ndarray, scipy.sparse.spmatrix, pd.Series, pd.DataFrame, pd.Categorical]
+        object to fingerprint, e.g. `adata.obsm['X_umap']`, `adata.obs[key]` or `adata.X`
+    identity: Bool, optional (default: `True`)
+        whether to include the address of the buffer,
+        must be `False` for fingerprints persisted across sessions
+    n_blocks: Int, optional (default: `{FINGERPRINT_N_BLOCKS}`)
+        number of blocks of rows to sample
+    block_size: Int, optional (default: `{FINGERPRINT_BLOCK_SIZE}`)
+        number of consecutive rows (and columns) in each block
 
     Returns
     --------
-    is_type: Bool
-        `True` if the objects is instance of class `type` or
-        all the element of the tuple is of class `type`
+    token: Str
+        version token of the object
     '''
 
-    return isinstance(obj, type) or (isinstance(obj, tuple) and all(map(lambda o: isinstance(o, type), obj)))
+    digest = hashlib.blake2b(digest_size=16)
+    _update_fingerprint(digest, obj, identity, n_blocks, block_size)
 
-def is_numeric(obj):
+    return digest.hexdigest()
+
+
+def field_fingerprint(adata, attr, key=None, identity=True):
     '''
-    Params
-    obj: Object
-        Python object
+    Fingerprint a field of an `anndata.AnnData` object.
 
+    Params
     --------
+    adata: anndata.AnnData
+        anndata object
+    attr: Str
+        attribute of `adata`, such as `'X'`, `'obs'` or `'obsm'`
+    key: Str, optional (default: `None`)
+        key in `adata.{attr}`, e.g. `'X_umap'`, if `None`, fingerprint the whole attribute
+    identity: Bool, optional (default: `True`)
+        whether to include the address of the buffer
+
     Returns
-    is_numeric: Bool
-        `True` if the object is numeric, else `False`
     --------
+    token: Str
+        version token of the field
     '''
-    return all(hasattr(obj, attr)
-               for attr in ('__add__', '__sub__', '__mul__', '__truediv__', '__pow__'))
 
+    obj = getattr(adata, attr)
+    if key is not None:
+        obj = obj[key]
 
-def is_categorical(obj):
+    return fingerprint(obj, identity=identity)
+
+
+class LRUCache(MutableMapping):
     '''
-    Is the object categorical?
+    Dictionary which evicts the least recently used entries.
 
     Params
     --------
-    obj: Python object
-        object that has attribute `'dtype'`,
+    max_entries: Int, optional (default: `None`)
+        maximum number of entries, if `None`, it's unbounded
+    max_bytes: Int, optional (default: `None`)
+        maximum number of bytes held by the entries, as reported by `get_nbytes`,
+        if `None`, it's unbounded
+        the size of an entry is updated whenever it's accessed
+        the most recently added entry is never evicted, even if it exceeds the budget
+
+    All the operations are thread-safe.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.nbytes = 0
+
+        self._data = odict()
+        self._nbytes = dict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            self._recount(key)
+
+            return value
+
+    def __setitem__(self, key, value):
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if key in self._data:
+                del self[key]
+
+            self._data[key] = value
+            self._nbytes[key] = nbytes
+            self.nbytes += nbytes
+
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+            self.nbytes -= self._nbytes.pop(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.info()})'
+
+    def _recount(self, key):
+        # the entry may have grown since it was added, e.g. `SampledView.points`
+        nbytes = get_nbytes(self._data[key])
+        if nbytes != self._nbytes[key]:
+            self.nbytes += nbytes - self._nbytes[key]
+            self._nbytes[key] = nbytes
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > 1 and \
+                ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                 (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            del self[next(iter(self._data))]
+            self.evictions += 1
+
+    def info(self):
+        '''
+        Get the cache statistics.
+
+        Returns
+        --------
+        info: Dict
+            number of hits, misses, evictions, entries and bytes held
+        '''
+
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self), nbytes=self.nbytes,
+                    max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+
+class ColumnAccessor:
+    '''
+    Column-oriented access to an expression matrix.
+
+    Sparse matrices are converted to CSC format once in a background thread,
+    until then, the columns are taken from the original matrix.
+    Recently used dense columns are cached.
+    Unless `own=True`, only a weak reference to the matrix is kept,
+    its owner keeps it alive.
+
+    Params
+    --------
+    matrix: Union[np.ndarray, scipy.sparse.spmatrix]
+        expression matrix of shape `(n_obs, n_vars)`
+    var_names: pd.Index
+        names of the columns
+    max_bytes: Int, optional (default: `COLUMN_CACHE_MAX_BYTES`)
+        maximum number of bytes held by the cached columns
+    own: Bool, optional (default: `False`)
+        whether to keep the matrix alive, e.g. when it's
+        created on each access, as for views of `anndata.AnnData`
+    '''
+
+    def __init__(self, matrix, var_names, max_bytes=COLUMN_CACHE_MAX_BYTES, own=False):
+        self._matrix = (lambda: matrix) if own else weakref.ref(matrix)
+        self._own = own
+        self.var_names = pd.Index(var_names)
+        self.cache = LRUCache(max_bytes=max_bytes)
+
+        self._lock = threading.RLock()
+        self._csc = None
+        if issparse(matrix) and matrix.format != 'csc':
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._csc = executor.submit(matrix.tocsc)
+            executor.shutdown(wait=False)
+            # the copy has as many stored elements as the original
+            self._csc_nbytes = get_nbytes(matrix)
+
+    @property
+    def matrix(self):
+        return self._matrix()
+
+    @property
+    def nbytes(self):
+        # only the CSC copy and the columns are owned by the accessor, unless it owns the matrix
+        csc = 0 if self._csc is None else self._csc_nbytes
+        matrix = get_nbytes(self.matrix) if self._own else 0
+        return csc + matrix + self.cache.nbytes
+
+    def _source(self):
+        # CSC matrix, if it's ready, otherwise the original one
+        if self._csc is not None and not issparse(self._csc) and \
+                self._csc.done() and self._csc.exception() is None:
+            self._csc = self._csc.result()
+        if issparse(self._csc):
+            return self._csc
+
+        matrix = self.matrix
+        assert matrix is not None, 'The matrix of the accessor no longer exists.'
+
+        return matrix
+
+    def _index(self, key):
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+
+        ix = self.var_names.get_loc(key)
+        assert isinstance(ix, (int, np.integer)), f'Key `{key}` is not unique in `var_names`.'
+
+        return ix
+
+    def _dense(self, source, ixs):
+        res = source[:, ixs]
+        res = res.toarray() if issparse(res) else np.asarray(res)
+
+        return res.reshape(-1, len(ixs))
+
+    def __getitem__(self, key):
+        '''
+        Get a single column.
+
+        Params
+        --------
+        key: Union[Str, Int]
+            name or index of the column
+
+        Returns
+        --------
+        column: np.ndarray
+            read-only dense column
+        '''
+
+        return self.columns([key])[:, 0]
+
+    def columns(self, keys):
+        '''
+        Get multiple columns at once.
+
+        Params
+        --------
+        keys: List[Union[Str, Int]]
+            names or indices of the columns
+
+        Returns
+        --------
+        columns: np.ndarray
+            dense array of shape `(n_obs, len(keys))`
+        '''
+
+        ixs = [self._index(k) for k in keys]
+        with self._lock:
+            found = {ix: self.cache[ix] for ix in odict.fromkeys(ixs) if ix in self.cache}
+        missing = [ix for ix in odict.fromkeys(ixs) if ix not in found]
+
+        if len(missing):
+            dense = self._dense(self._source(), missing)
+            for i, ix in enumerate(missing):
+                col = np.array(dense[:, i])
+                col.flags.writeable = False
+                found[ix] = col
+            # the batch may exceed the budget, the cache only keeps what fits
+            with self._lock:
+                for ix in missing:
+                    self.cache[ix] = found[ix]
+
+        cols = [found[ix] for ix in ixs]
+
+        if len(cols) == 1:
+            return cols[0][:, None]
+
+        return np.stack(cols, axis=1)
+
+
+_COLUMN_ACCESSORS = LRUCache(max_entries=COLUMN_ACCESSORS_MAX_ENTRIES, max_bytes=COLUMN_ACCESSORS_MAX_BYTES)
+
+
+def expression_accessor(adata, layer=None):
+    '''
+    Get the shared `ColumnAccessor` of `adata.X`, `adata.raw.X` or a layer.
+
+    The accessors are keyed by the object they come from, not by the matrix:
+    views of `anndata.AnnData` create a new matrix on each access,
+    so their accessor keeps the first one alive instead. Accessors
+    of actual objects are rebuilt when the fingerprint of the matrix changes.
+
+    Params
+    --------
+    adata: Union[anndata.AnnData, anndata.Raw]
+        anndata object or its `.raw` attribute
+    layer: Str, optional (default: `None`)
+        layer in `adata.layers`, if `None`, use `adata.X`
 
     Returns
     --------
-    is_categorical: Bool
-        `True` if it's categorical else `False`
+    accessor: Union[ColumnAccessor, NoneType]
+        the accessor or `None` if the matrix is not in memory
     '''
 
-    return obj.dtype.name == 'category'
+    if getattr(adata, 'isbacked', False):
+        return None
+
+    is_view = getattr(adata, 'is_view', False)
+    key = (id(adata), layer)
+
+    # get or create atomically, so that concurrent callers don't convert the same matrix twice
+    with _COLUMN_ACCESSORS._lock:
+        accessor = _COLUMN_ACCESSORS.get(key, None)
+        if accessor is not None and accessor.owner() is adata:
+            # views can't be modified without turning into actual objects first
+            if is_view:
+                return accessor
+            matrix = adata.X if layer is None else adata.layers[layer]
+            # also detects in-place modifications, e.g. by `sc.pp.log1p`
+            if accessor.matrix is matrix and accessor.token == fingerprint(matrix):
+                return accessor
+
+        matrix = adata.X if layer is None else adata.layers[layer]
+        if not (issparse(matrix) or isinstance(matrix, np.ndarray)):
+            return None
 
+        accessor = ColumnAccessor(matrix, adata.var_names, own=is_view)
+        accessor.owner = weakref.ref(adata)
+        accessor.token = None if is_view else fingerprint(matrix)
+        _COLUMN_ACCESSORS[key] = accessor
 
-def minmax(component, perc=None, is_sorted=False):
+    # drop the accessor, along with its copy of the matrix, once the owner is gone
+    weakref.finalize(adata, _drop_column_accessor, key, weakref.ref(accessor))
+
+    return accessor
+
+
+def _drop_column_accessor(key, ref):
+    with _COLUMN_ACCESSORS._lock:
+        if key in _COLUMN_ACCESSORS and _COLUMN_ACCESSORS._data[key] is ref():
+            del _COLUMN_ACCESSORS[key]
+
+
+def gene_vector(adata, key, layer=None):
     '''
-    Get the minimum and maximum value of an array.
+    Get the expression of a gene, same as `adata.obs_vector`,
+    but using the shared `ColumnAccessor`.
 
     Params
     --------
-    component: Union[np.ndarray, List, Tuple]
-        1-D array
-    perc: Union[List[Float], Tuple[Float]]
-        clip the values by the percentiles
-    is_sorted: Bool, optional (default: `False`)
-        whether the component is already sorted,
-        if `True`, min and max are the first and last
-        elements respectively
+    adata: Union[anndata.AnnData, anndata.Raw]
+        anndata object or its `.raw` attribute
+    key: Str
+        gene in `adata.var_names`
+    layer: Str, optional (default: `None`)
+        layer in `adata.layers`, if `None`, use `adata.X`
 
     Returns
     --------
-    min_max: Tuple[Float, Float]
-        minimum and maximum values that are not NaN
+    expression: np.ndarray
+        expression of the gene
+    '''
+
+    accessor = expression_accessor(adata, layer)
+    if accessor is None:
+        return adata.obs_vector(key) if layer is None else adata.obs_vector(key, layer=layer)
+
+    return accessor[key]
+
+
+KeyInfo = namedtuple('KeyInfo', ['where', 'key', 'ix', 'dtype', 'is_categorical', 'first'])
+KeyInfo.__doc__ = '''
+Location of an addressable key of `anndata.AnnData`.
+
+Params
+--------
+where: Str
+    attribute of `anndata.AnnData`, one of `'obs'`, `'obsm'`, `'var_names'`
+key: Str
+    key in `adata.{where}`
+ix: Int
+    column index, `None` for `adata.obs` and 1-D arrays in `adata.obsm`
+dtype: np.dtype
+    data type of the values
+is_categorical: Bool
+    whether the values are categorical
+first: Object
+    value of the first observation when the index was built, used for type checking
+'''
+
+
+class KeyIndex:
+    f'''
+    Index of all the keys addressable in an `anndata.AnnData` object.
+
+    Maps columns of `adata.obs`, keys of `adata.obsm` (also with `'{OBSM_SEP}ix'`),
+    and genes in `adata.var_names` and `adata.raw.var_names` to their location.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    '''
+
+    def __init__(self, adata):
+        self.token = KeyIndex.version(adata)
+        self.keys = dict()
+
+        for key, col in adata.obs.items():
+            self.keys[key] = KeyInfo('obs', key, None, col.dtype, is_categorical(col),
+                                     col.iloc[0] if len(col) else None)
+
+        for key in adata.obsm.keys():
+            arr = adata.obsm[key]
+            if not hasattr(arr, 'shape') or not hasattr(arr, 'dtype'):
+                continue
+            first = arr[0] if arr.shape[0] else None
+            if issparse(first):
+                first = first.toarray().ravel()
+            # `adata.obs` takes precedence
+            self.keys.setdefault(key, KeyInfo('obsm', key, None, arr.dtype, False, first))
+            if arr.ndim == 2:
+                for ix in range(arr.shape[1]):
+                    self.keys.setdefault(f'{key}{OBSM_SEP}{ix}', KeyInfo('obsm', key, ix, arr.dtype, False,
+                                                                         None if first is None else first[ix]))
+
+        self.var_names = adata.var_names
+        self.raw_var_names = adata.raw.var_names if adata.raw is not None else None
+        self.dtype = getattr(adata.X, 'dtype', None)
+
+    @staticmethod
+    def version(adata):
+        '''
+        Get the token which changes when the keys of `adata` or their types change.
+
+        Params
+        --------
+        adata: anndata.AnnData
+            anndata object
+
+        Returns
+        --------
+        token: Tuple
+            version token
+        '''
+
+        raw = adata.raw
+        # only the keys, dtypes and shapes, the values are never read,
+        # the indices are compared by identity, since they're replaced rather than modified
+        return (tuple(adata.obs.columns), tuple(map(str, adata.obs.dtypes)), adata.n_obs,
+                tuple((k, getattr(v, 'shape', None), str(getattr(v, 'dtype', None))) for k, v in adata.obsm.items()),
+                id(adata.var_names), adata.n_vars,
+                None if raw is None else (id(raw.var_names), len(raw.var_names)))
+
+    def resolve(self, needle, where=('obs', 'obsm', 'var_names'), raw=False):
+        '''
+        Find the location of a key.
+
+        Params
+        --------
+        needle: Str
+            key to search for, e.g. `'louvain'`, `'X_umap:0'` or a gene name
+        where: Tuple[Str], optional (default: `('obs', 'obsm', 'var_names')`)
+            attributes to search, in this order
+        raw: Bool, optional (default: `False`)
+            whether to look up genes in `adata.raw.var_names`
+
+        Returns
+        --------
+        info: Union[KeyInfo, NoneType]
+            location of the key or `None` if not found
+        '''
+
+        info = self.keys.get(needle, None)
+        if info is not None and info.where in where:
+            return info
+
+        if 'var_names' in where:
+            var_names = self.raw_var_names if raw else self.var_names
+            if var_names is not None and needle in var_names:
+                ix = var_names.get_loc(needle)
+                if isinstance(ix, (int, np.integer)):
+                    return KeyInfo('var_names', needle, int(ix), self.dtype, False, None)
+
+        return None
+
+
+_KEY_INDICES = LRUCache(max_entries=KEY_INDICES_MAX_ENTRIES)
+
+
+def key_index(adata):
+    '''
+    Get the `KeyIndex` of an `anndata.AnnData` object.
+
+    It is built once per object and rebuilt when its keys change.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+
+    Returns
+    --------
+    index: KeyIndex
+        the key index
+    '''
+
+    ref, index = _KEY_INDICES.get(id(adata), (None, None))
+    if ref is not None and ref() is adata and index.token == KeyIndex.version(adata):
+        return index
+
+    index = KeyIndex(adata)
+    _KEY_INDICES[id(adata)] = weakref.ref(adata), index
+
+    return index
+
+
+_DENSITY_CACHE = LRUCache(max_entries=DENSITY_CACHE_MAX_ENTRIES)
+
+
+class SamplingLazyDict(LRUCache):
+    '''
+    Cache of subsampled data, lazily computed for each `(basis, components)`.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    subsample: Str
+        subsampling strategy, `'uniform'` and `'density'` are computed,
+        otherwise all the observations are used
+    callback_kwargs: Dict, optional (default: `{}`)
+        keyword arguments for the sampling function
+    max_entries: Int, optional (default: `SAMPLING_CACHE_MAX_ENTRIES`)
+        maximum number of cached samples
+    max_bytes: Int, optional (default: `SAMPLING_CACHE_MAX_BYTES`)
+        maximum number of bytes held by the cached samples
+
+    Samples are recomputed when the fingerprint of their basis changes. The components
+    are unordered, i.e. `(bs, (0, 1))` and `(bs, (1, 0))` share the same sample,
+    which is computed with the components in ascending order.
+    When nothing is computed, all the keys share the same view and nothing is cached.
+    '''
+
+    def __init__(self, adata, subsample, callback_kwargs={}, max_entries=None, max_bytes=None):
+        super().__init__(max_entries=SAMPLING_CACHE_MAX_ENTRIES if max_entries is None else max_entries,
+                         max_bytes=SAMPLING_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+        self.adata = adata
+        self.callback_kwargs = callback_kwargs
+        self.is_computed = subsample in ('uniform', 'density', 'lod')
+
+        self._pending = dict()
+        self._tokens = dict()
+        self._limits = dict()
+
+        if subsample == 'uniform':
+            self.callback = sample_unif
+        elif subsample == 'density':
+            self.callback = sample_density
+        elif subsample == 'lod':
+            self.callback = sample_lod
+        else:
+            self.view = SampledView(adata)
+            self.callback = None
+
+    @staticmethod
+    def _canonical(key):
+        bs, comps = key
+        return bs, tuple(sorted(map(int, comps)))
+
+    def __getitem__(self, key):
+        if not self.is_computed:
+            return self.view, self.view.ixs
+
+        bs, comps = key
+        key = self._canonical(key)
+        token = self._token(bs)
+
+        while True:
+            with self._lock:
+                if key in self and self._tokens.get(key, None) != token:
+                    del self[key]
+
+                if key in self:
+                    view = super().__getitem__(key)
+                    return view, view.ixs
+
+                done, future_token = self._pending.get(key, (None, None))
+                if done is None or future_token != token:
+                    # other callers wait for this computation instead of repeating it
+                    done = threading.Event()
+                    self._pending[key] = done, token
+                    self.misses += 1
+                    break
+            # the result is stored once it's done, if it failed, compute it here
+            done.wait()
+
+        try:
+            # computed with the canonical components, `query` swaps the ranges if needed
+            view, _ = self.callback(self.adata, bs=bs, components=key[1], **self.callback_kwargs)
+            with self._lock:
+                self._set(key, view, token)
+        finally:
+            with self._lock:
+                if self._pending.get(key, (None, None))[0] is done:
+                    del self._pending[key]
+            done.set()
+
+        return view, view.ixs
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._tokens.pop(key, None)
+
+    def _token(self, bs):
+        # samples which are not computed don't depend on the basis
+        return fingerprint(self.adata.obsm[f'X_{bs}']) if self.is_computed else None
+
+    def _set(self, key, value, token):
+        self[key] = value
+        self._tokens[key] = token
+
+    def _store(self, key, token, done, future):
+        try:
+            with self._lock:
+                if self._pending.get(key, (None, None))[0] is done:
+                    del self._pending[key]
+                if future.exception() is None:
+                    self.misses += 1
+                    self._set(key, future.result()[0], token)
+        finally:
+            done.set()
+
+    def prefetch(self, keys, n_jobs=None):
+        '''
+        Compute the samples in the background.
+
+        Params
+        --------
+        keys: Iterable[Tuple[Str, Tuple[Int, Int]]]
+            basis and components for which to compute the samples
+        n_jobs: Int, optional (default: `None`)
+            number of threads to use, if `None`, use the default of
+            `concurrent.futures.ThreadPoolExecutor`
+
+        Returns
+        --------
+        None
+            nothing, `self[key]` waits for the computation to finish
+        '''
+
+        if not self.is_computed:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+        with self._lock:
+            for bs, comps in keys:
+                key = self._canonical((bs, comps))
+                if key in self or key in self._pending:
+                    continue
+
+                token = self._token(bs)
+                done = threading.Event()
+                self._pending[key] = done, token
+                future = executor.submit(self.callback, self.adata, bs=bs, components=key[1], **self.callback_kwargs)
+                future.add_done_callback(partial(self._store, key, token, done))
+
+        # already submitted tasks will still run
+        executor.shutdown(wait=False)
+
+    def query(self, key, x_range=None, y_range=None, scale=1):
+        '''
+        Get the sample restricted to a viewport.
+
+        Params
+        --------
+        key: Tuple[Str, Tuple[Int, Int]]
+            basis and its components
+        x_range: Tuple[Float, Float], optional (default: `None`)
+            range of the first component
+        y_range: Tuple[Float, Float], optional (default: `None`)
+            range of the second component
+        scale: Float, optional (default: `1`)
+            factor by which the plotted embedding was multiplied
+
+        Returns
+        --------
+        (view, ixs): Tuple[SampledView, np.ndarray]
+            for `subsample='lod'`, refined sample inside the viewport,
+            otherwise the same as `self[key]`
+        '''
+
+        res, ixs = self[key]
+        if not isinstance(res, LODView):
+            return res, ixs
+
+        x_range, y_range = (None if r is None else (r[0] / scale, r[1] / scale) for r in (x_range, y_range))
+        if int(key[1][0]) > int(key[1][1]):
+            # the view was built with the components in ascending order
+            x_range, y_range = y_range, x_range
+        res = res.query(x_range, y_range)
+
+        return res, res.ixs
+
+    def limits(self, key, scale=1):
+        '''
+        Get the axis limits of the whole embedding, regardless of the sample or the viewport.
+
+        Params
+        --------
+        key: Tuple[Str, Tuple[Int, Int]]
+            basis and its components
+        scale: Float, optional (default: `1`)
+            factor by which the plotted embedding was multiplied
+
+        Returns
+        --------
+        (xlim, ylim): Tuple[Tuple[Float, Float], Tuple[Float, Float]]
+            minimum and maximum of the components
+        '''
+
+        bs, comps = key
+        comps = tuple(map(int, comps))
+        data = self.adata.obsm[f'X_{bs}']
+        token = fingerprint(data)
+
+        with self._lock:
+            cached_token, lims = self._limits.get((bs, comps), (None, None))
+        if cached_token != token:
+            lims = tuple(minmax(data[:, c]) for c in comps)
+            with self._lock:
+                self._limits[bs, comps] = token, lims
+
+        return tuple((minn * scale, maxx * scale) for minn, maxx in lims)
+
+
+def component_pairs(adata, basis, components):
+    '''
+    Get the default and adjacent pairs of components for each basis.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    basis: List[Str]
+        basis in `adata.obsm`
+    components: np.ndarray
+        0-based default components for each basis, shape `(len(basis), 2)`
+
+    Returns
+    --------
+    keys: List[Tuple[Str, Tuple[Int, Int]]]
+        keys for `SamplingLazyDict`, the default components first
+    '''
+
+    keys = [(bs, tuple(map(int, comp))) for bs, comp in zip(basis, components)]
+    for bs in basis:
+        n_comps = adata.obsm[f'X_{bs}'].shape[-1]
+        keys.extend((bs, (i, i + 1)) for i in range(n_comps - 1))
+
+    return list(odict.fromkeys(keys))
+
+
+# cache key of an element's data by `id`, removed once the data is garbage collected
+_AGGREGATE_KEYS = dict()
+
+
+def set_aggregate_key(element, *key):
+    '''
+    Identify the data of an element so that its aggregates can be cached.
+
+    Params
+    --------
+    element: holoviews.Element
+        element, such as `hv.Scatter`
+    key: Tuple
+        hashable key identifying the data, such as `(condition, basis, components)`
+
+    Returns
+    --------
+    element: holoviews.Element
+        the same element
+    '''
+
+    data_id = id(element.data)
+    if data_id not in _AGGREGATE_KEYS:
+        weakref.finalize(element.data, _AGGREGATE_KEYS.pop, data_id, None)
+    _AGGREGATE_KEYS[data_id] = key
+
+    return element
+
+
+def get_aggregate_key(element):
+    '''
+    Get the key identifying the data of an element.
+
+    The key set by `set_aggregate_key` is extended with a content
+    fingerprint of the data, in case it was modified in the meantime.
+
+    Params
+    --------
+    element: holoviews.Element
+        element, such as `hv.Scatter`
+
+    Returns
+    --------
+    key: Union[Tuple, NoneType]
+        key of the data or `None` if it was not set
+    '''
+
+    key = _AGGREGATE_KEYS.get(id(element.data), None)
+    if key is None:
+        return None
+
+    return key + (fingerprint(element.data, identity=False),)
+
+
+def quantize_range(rng, digits=RANGE_QUANTIZATION_DIGITS):
+    f'''
+    Snap a range outwards to a grid relative to its span.
+
+    Nearby ranges, e.g. after panning by less than a pixel,
+    map to the same range.
+
+    Params
+    --------
+    rng: Union[Tuple[Float, Float], NoneType]
+        range to quantize
+    digits: Int, optional (default: `{RANGE_QUANTIZATION_DIGITS}`)
+        the grid step is `10 ** -digits` of the span's order of magnitude
+
+    Returns
+    --------
+    rng: Union[Tuple[Float, Float], NoneType]
+        quantized range, containing the original one
+    '''
+
+    if rng is None:
+        return None
+
+    low, high = map(float, rng)
+    span = high - low
+    if not np.isfinite(span) or span <= 0:
+        return rng
+
+    step = 10 ** (np.floor(np.log10(span)) - digits)
+
+    return (float(np.floor(low / step) * step), float(np.ceil(high / step) * step))
+
+
+def _tile_keys(px, py, level, tile_size):
+    # sort key of pixels, by tile (row-major) and then by the position within the tile
+    n_tiles = 1 << level
+    tiles = (py // tile_size) * n_tiles + (px // tile_size)
+
+    return tiles * tile_size ** 2 + (py % tile_size) * tile_size + (px % tile_size)
+
+
+def _split_pixels(starts, size, origin, delta):
+    # output pixels overlapped by source pixels `[start, start + size)`, `size <= delta`,
+    # and the fraction of each source pixel in them
+    first = np.floor((starts - origin) / delta)
+    inside = np.clip((origin + (first + 1) * delta - starts) / size, 0, 1)
+
+    return np.stack([first, first + 1], axis=1), np.stack([inside, 1 - inside], axis=1)
+
+
+class TilePyramid:
+    f'''
+    Multi-level aggregates of points, split into tiles.
+
+    Level `l` is a grid of `2 ** l x 2 ** l` tiles of `tile_size x tile_size` pixels
+    covering the extent of the points. Non-empty pixels of each level are sorted
+    by tile, so the ones covering a viewport are read by slicing. The finest level
+    also keeps the points themselves, so that zooming in further is exact.
+
+    Params
+    --------
+    x: np.ndarray
+        x coordinates of the points
+    y: np.ndarray
+        y coordinates of the points
+    values: Union[np.ndarray, pd.Categorical]
+        values of the points, categorical values are counted per category (as `count_cat`),
+        numerical values are averaged (as `mean`), missing values are ignored
+    tile_size: Int, optional (default: `{TILE_SIZE}`)
+        size of the tiles in pixels
+    n_levels: Int, optional (default: `None`)
+        number of levels, if `None`, it's determined by the number of points
+    '''
+
+    def __init__(self, x, y, values, tile_size=TILE_SIZE, n_levels=None):
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        valid = np.isfinite(x) & np.isfinite(y)
+
+        self.is_categorical = is_categorical(values)
+        if self.is_categorical:
+            values = pd.Categorical(values)
+            self.categories = values.categories
+            codes = values.codes.astype(np.int64)
+            valid &= codes >= 0
+            codes, values = codes[valid], None
+        else:
+            self.categories = None
+            values = np.asarray(values, dtype=np.float64)
+            valid &= ~np.isnan(values)
+            codes, values = None, values[valid]
+
+        x, y = x[valid], y[valid]
+        self.n_cats = 1 if self.categories is None else max(len(self.categories), 1)
+
+        if n_levels is None:
+            n_levels = int(np.clip(np.ceil(np.log2(max(np.sqrt(len(x)), 1) / tile_size)) + 2, 1, TILE_MAX_LEVELS))
+        assert n_levels >= 1, f'`n_levels` must be positive, found `{n_levels}`.'
+
+        self.tile_size = tile_size
+        self.n_levels = n_levels
+        self.x_min, self.x_span = (np.min(x), np.ptp(x)) if len(x) else (0, 0)
+        self.y_min, self.y_span = (np.min(y), np.ptp(y)) if len(y) else (0, 0)
+        self.x_span, self.y_span = self.x_span or 1, self.y_span or 1
+
+        res = tile_size << (n_levels - 1)
+        px = np.clip(np.floor((x - self.x_min) / self.x_span * res), 0, res - 1).astype(np.int64)
+        py = np.clip(np.floor((y - self.y_min) / self.y_span * res), 0, res - 1).astype(np.int64)
+
+        # the finest level keeps the points, each with a count of `1`
+        keys = _tile_keys(px, py, n_levels - 1, tile_size)
+        order = np.argsort(keys, kind='stable')
+        take = lambda arr: None if arr is None else arr[order]
+        self.points = (x[order], y[order], take(codes), None, take(values),
+                       self._tile_starts(keys[order], n_levels - 1))
+
+        self.levels = [None] * n_levels
+        counts, sums = None, values
+        for level in reversed(range(n_levels)):
+            px, py, codes, counts, sums, keys = self._aggregate(px, py, codes, counts, sums, level)
+            self.levels[level] = (px, py, codes, counts, sums, self._tile_starts(keys, level))
+            px, py = px >> 1, py >> 1
+
+    @property
+    def nbytes(self):
+        return get_nbytes(self.points) + get_nbytes(self.levels)
+
+    def _tile_starts(self, keys, level):
+        tiles = keys // self.tile_size ** 2
+        return np.searchsorted(tiles, np.arange((1 << level) ** 2 + 1), side='left')
+
+    def _aggregate(self, px, py, codes, counts, sums, level):
+        keys = _tile_keys(px, py, level, self.tile_size)
+        if codes is not None:
+            keys = keys * self.n_cats + codes
+        keys, inv = np.unique(keys, return_inverse=True)
+
+        counts = np.bincount(inv, weights=counts, minlength=len(keys))
+        if sums is not None:
+            sums = np.bincount(inv, weights=sums, minlength=len(keys))
+
+        if codes is not None:
+            codes = keys % self.n_cats
+            keys //= self.n_cats
+        n_tiles, tile_area = 1 << level, self.tile_size ** 2
+        tiles, within = keys // tile_area, keys % tile_area
+        px = (tiles % n_tiles) * self.tile_size + within % self.tile_size
+        py = (tiles // n_tiles) * self.tile_size + within // self.tile_size
+
+        return px, py, codes, counts, sums, keys
+
+    def _covering(self, starts, level, x_range, y_range):
+        # indices of the pixels (or points) in the tiles covering the viewport
+        n_tiles = 1 << level
+        tx0, tx1 = np.clip(np.floor((np.array(x_range) - self.x_min) / self.x_span * n_tiles), 0, n_tiles - 1).astype(np.int64)
+        ty0, ty1 = np.clip(np.floor((np.array(y_range) - self.y_min) / self.y_span * n_tiles), 0, n_tiles - 1).astype(np.int64)
+
+        # tiles in a row are contiguous
+        return np.concatenate([np.arange(starts[ty * n_tiles + tx0], starts[ty * n_tiles + tx1 + 1])
+                               for ty in range(ty0, ty1 + 1)])
+
+    def query(self, x_range=None, y_range=None, width=TILE_SIZE, height=TILE_SIZE):
+        f'''
+        Aggregate the points in a viewport.
+
+        Only the pixels of the coarsest level which is at least as fine as the viewport are read,
+        so the cost depends on the size of the viewport rather than on the number of points.
+        They're resampled into the viewport with area weighting, so the counts are fractional.
+
+        Params
+        --------
+        x_range: Tuple[Float, Float], optional (default: `None`)
+            range of the viewport in the x dimension, if `None`, use the whole extent
+        y_range: Tuple[Float, Float], optional (default: `None`)
+            range of the viewport in the y dimension, if `None`, use the whole extent
+        width: Int, optional (default: `{TILE_SIZE}`)
+            width of the aggregate in pixels
+        height: Int, optional (default: `{TILE_SIZE}`)
+            height of the aggregate in pixels
+
+        Returns
+        --------
+        (xs, ys, agg): Tuple[np.ndarray, np.ndarray, np.ndarray]
+            centers of the pixels and the aggregate of shape `(height, width)` with means
+            (`NaN` for empty pixels) or `(height, width, n_categories)` with counts
+        '''
+
+        if x_range is None:
+            x_range = (self.x_min, self.x_min + self.x_span)
+        if y_range is None:
+            y_range = (self.y_min, self.y_min + self.y_span)
+
+        (x0, x1), (y0, y1) = x_range, y_range
+        dx, dy = (x1 - x0) / width, (y1 - y0) / height
+        xs, ys = x0 + (np.arange(width) + 0.5) * dx, y0 + (np.arange(height) + 0.5) * dy
+
+        # number of tiles per side needed to match the resolution of the viewport
+        n_tiles = max(self.x_span / dx if dx > 0 else 1, self.y_span / dy if dy > 0 else 1) / self.tile_size
+        level = int(np.ceil(np.log2(max(n_tiles, 1))))
+
+        if level < self.n_levels:
+            px, py, codes, counts, sums, starts = self.levels[level]
+            ixs = self._covering(starts, level, x_range, y_range)
+            res = self.tile_size << level
+            # the source pixels are up to 2x finer than the viewport's and don't align with them,
+            # so each one is split between the (at most 2 x 2) pixels it overlaps, by area
+            (ox, wx), (oy, wy) = (_split_pixels(start + pix[ixs] * (span / res), span / res, lo, delta)
+                                  for pix, start, span, lo, delta in ((px, self.x_min, self.x_span, x0, dx),
+                                                                      (py, self.y_min, self.y_span, y0, dy)))
+            ox, oy = np.repeat(ox, 2, axis=1), np.tile(oy, 2)
+            weights = (np.repeat(wx, 2, axis=1) * np.tile(wy, 2)).ravel()
+            ixs = np.repeat(ixs, 4)
+            ox, oy = ox.ravel(), oy.ravel()
+        else:
+            x, y, codes, counts, sums, starts = self.points
+            ixs = self._covering(starts, self.n_levels - 1, x_range, y_range)
+            ox, oy = np.floor((x[ixs] - x0) / dx), np.floor((y[ixs] - y0) / dy)
+            weights = np.ones(len(ixs))
+
+        mask = (ox >= 0) & (ox < width) & (oy >= 0) & (oy < height) & (weights > 0)
+        ixs, weights = ixs[mask], weights[mask]
+        bins = oy[mask].astype(np.int64) * width + ox[mask].astype(np.int64)
+        if codes is not None:
+            bins = bins * self.n_cats + codes[ixs]
+
+        size = width * height * self.n_cats
+        agg_counts = np.bincount(bins, weights=weights if counts is None else counts[ixs] * weights, minlength=size)
+        if self.is_categorical:
+            return xs, ys, agg_counts.reshape(height, width, self.n_cats)
+
+        agg_sums = np.bincount(bins, weights=sums[ixs] * weights, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            agg = agg_sums / agg_counts
+        agg[agg_counts == 0] = np.nan
+
+        return xs, ys, agg.reshape(height, width)
+
+
+class PixelIndex:
+    '''
+    Pixels of a canvas into which the points fall.
+
+    Binning the points is the same for all the values drawn at them,
+    so it's done once per viewport and the aggregates are then just counts.
+
+    Params
+    --------
+    x: np.ndarray
+        x coordinates of the points
+    y: np.ndarray
+        y coordinates of the points
+    x_range: Tuple[Float, Float]
+        range of the canvas in the x dimension
+    y_range: Tuple[Float, Float]
+        range of the canvas in the y dimension
+    width: Int
+        width of the canvas in pixels
+    height: Int
+        height of the canvas in pixels
+    '''
+
+    def __init__(self, x, y, x_range, y_range, width, height):
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        (x0, x1), (y0, y1) = x_range, y_range
+        dx, dy = (x1 - x0) / width, (y1 - y0) / height
+
+        self.width, self.height = width, height
+        self.xs, self.ys = x0 + (np.arange(width) + 0.5) * dx, y0 + (np.arange(height) + 0.5) * dy
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ox, oy = np.floor((x - x0) / dx), np.floor((y - y0) / dy)
+        # as in `datashader`, the upper bounds are inclusive
+        ox[x == x1], oy[y == y1] = width - 1, height - 1
+        mask = (ox >= 0) & (ox < width) & (oy >= 0) & (oy < height)
+
+        # only the points inside the canvas are kept
+        self.n_points = len(x)
+        self.ixs = np.flatnonzero(mask)
+        dtype = np.int32 if width * height < 2 ** 31 else np.int64
+        self.pixels = (oy[self.ixs] * width + ox[self.ixs]).astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.xs.nbytes + self.ys.nbytes + self.ixs.nbytes + self.pixels.nbytes
+
+    def count_cat(self, codes, n_cats):
+        '''
+        Count the points of each category in each pixel.
+
+        Params
+        --------
+        codes: np.ndarray
+            category codes of the points, negative ones are ignored
+        n_cats: Int
+            number of categories
+
+        Returns
+        --------
+        agg: np.ndarray
+            counts of shape `(height, width, n_cats)`
+        '''
+
+        codes = np.asarray(codes)
+        assert len(codes) == self.n_points, f'Expected `{self.n_points}` codes, found `{len(codes)}`.'
+
+        codes = codes[self.ixs]
+        mask = codes >= 0
+        bins = self.pixels[mask].astype(np.int64) * n_cats + codes[mask]
+
+        return np.bincount(bins, minlength=self.width * self.height * n_cats).reshape(self.height, self.width, n_cats)
+
+
+# ascii codes of the hex representation of each byte
+_HEX_CHARS = np.array([list(f'{i:02x}'.encode()) for i in range(256)], dtype=np.uint8)
+
+
+def _to_bytes(rgba):
+    rgba = np.asarray(rgba)
+    if rgba.dtype == np.uint8:
+        return rgba
+
+    return np.clip(np.rint(rgba * 255), 0, 255).astype(np.uint8)
+
+
+def rgba_to_hex(rgba):
+    '''
+    Convert RGB(A) colors to hex strings, ignoring the alpha channel.
+
+    Params
+    --------
+    rgba: np.ndarray
+        array of shape `(n, 3)` or `(n, 4)`, either floats
+        in `[0, 1]` or `np.uint8`
+
+    Returns
+    --------
+    hex_colors: np.ndarray
+        array of shape `(n,)` with colors as `'#rrggbb'`
+    '''
+
+    rgba = _to_bytes(rgba)
+    res = np.empty((rgba.shape[0], 7), dtype=np.uint8)
+    res[:, 0] = ord('#')
+    for i in range(3):
+        res[:, 1 + 2 * i: 3 + 2 * i] = _HEX_CHARS[rgba[:, i]]
+
+    return res.view('S7').ravel().astype('U7')
+
+
+def pack_rgba(rgba):
+    '''
+    Pack RGBA colors into 32-bit integers, as used by `bokeh`'s `image_rgba`.
+
+    Params
+    --------
+    rgba: np.ndarray
+        array of shape `(n, 4)`, either floats in `[0, 1]` or `np.uint8`
+
+    Returns
+    --------
+    packed: np.ndarray
+        `np.uint32` array of shape `(n,)`
+    '''
+
+    return np.ascontiguousarray(_to_bytes(rgba)).view(np.uint32).ravel()
+
+
+def palette_lut(cmap, n=PALETTE_SIZE):
+    f'''
+    Create a lookup table of a colormap.
+
+    Params
+    --------
+    cmap: Union[Str, matplotlib.colors.Colormap, List]
+        name of the `matplotlib` colormap, the colormap, a single color or a list of colors
+    n: Int, optional (default: `{PALETTE_SIZE}`)
+        number of colors to sample from the colormap, ignored for colors
+
+    Returns
+    --------
+    lut: np.ndarray
+        `np.uint8` array of shape `(n, 4)`
+    '''
+
+    if isinstance(cmap, str) and not colors.is_color_like(cmap):
+        cmap = cm.get_cmap(cmap)
+
+    if isinstance(cmap, colors.Colormap):
+        return _to_bytes(cmap(np.linspace(0, 1, n)))
+
+    if isinstance(cmap, str):
+        # a single color
+        cmap = [cmap]
+
+    return _to_bytes(colors.to_rgba_array(list(cmap)))
+
+
+_PALETTE_CACHE = LRUCache(max_entries=PALETTE_CACHE_MAX_ENTRIES)
+
+
+def hex_palette(cmap, n=PALETTE_SIZE):
+    f'''
+    Create a hex palette of bounded size from a colormap.
+
+    Params
+    --------
+    cmap: Union[Str, matplotlib.colors.Colormap, List]
+        name of the `matplotlib` colormap, the colormap or a list of colors
+    n: Int, optional (default: `{PALETTE_SIZE}`)
+        number of colors to sample from the colormap, ignored for list of colors
+
+    Returns
+    --------
+    palette: List[Str]
+        new list of colors in hex format
+    '''
+
+    if isinstance(cmap, colors.Colormap):
+        # names and ids of colormaps are not unique, key on the sampled colors
+        lut = palette_lut(cmap, n)
+        key = fingerprint(lut, identity=False, n_blocks=len(lut))
+    elif isinstance(cmap, str):
+        lut, key = None, (cmap, n)
+    else:
+        lut, key = None, tuple(map(str, cmap))
+
+    palette = _PALETTE_CACHE.get(key, None)
+    if palette is None:
+        lut = palette_lut(cmap, n) if lut is None else lut
+        palette = _PALETTE_CACHE[key] = tuple(rgba_to_hex(lut).tolist())
+
+    # a copy, so that the callers can't modify the cached palette
+    return list(palette)
+
+
+def to_hex_palette(palette, normalize=True):
+    """
+    Converts matplotlib color array to hex strings
+    """
+    if not isinstance(palette, np.ndarray):
+        palette = np.array(palette)
+
+    if isinstance(palette[0], str):
+        assert all(map(colors.is_color_like, palette)), 'Not all strings are color like.'
+        return palette
+
+    if normalize:
+        minn = np.min(palette)
+        # normalize to [0, 1]
+        palette = (palette - minn) / (np.max(palette) - minn)
+
+    if palette.ndim == 2 and palette.shape[1] in (3, 4):
+        return rgba_to_hex(palette).tolist()
+
+    return [colors.to_hex(c) if colors.is_color_like(c) else c for c in palette]
+
+
+def pad(minn, maxx, padding=0.05):
+    if minn > maxx:
+        maxx, minn = minn, maxx
+    return minn - padding, maxx + padding
+
+
+def iterable(obj):
+    '''
+    Checks whether the object is iterable non-string.
+    
+    Params
+    --------
+    obj: Object
+        Python object
+
+    Returns
+    --------
+    is_iterable: Bool
+        whether the object is not `str` and is
+        instance of class `Iterable`
+    '''
+
+    return not isinstance(obj, str) and isinstance(obj, Iterable)
+
+
+def istype(obj):
+    '''
+    Checks whether the object is of class `type`.
+
+    Params
+    --------
+    obj: Union[Object, Tuple]
+        Python object or a tuple
+
+    Returns
+    --------
+    is_type: Bool
+        `True` if the objects is instance of class `type` or
+        all the element of the tuple is of class `type`
+    '''
+
+    return isinstance(obj, type) or (isinstance(obj, tuple) and all(map(lambda o: isinstance(o, type), obj)))
+
+def is_numeric(obj):
+    '''
+    Params
+    obj: Object
+        Python object
+
+    --------
+    Returns
+    is_numeric: Bool
+        `True` if the object is numeric, else `False`
+    --------
+    '''
+    return all(hasattr(obj, attr)
+               for attr in ('__add__', '__sub__', '__mul__', '__truediv__', '__pow__'))
+
+
+def is_categorical(obj):
+    '''
+    Is the object categorical?
+
+    Params
+    --------
+    obj: Python object
+        object that has attribute `'dtype'`,
+
+    Returns
+    --------
+    is_categorical: Bool
+        `True` if it's categorical else `False`
+    '''
+
+    return obj.dtype.name == 'category'
+
+
+def minmax(component, perc=None, is_sorted=False):
+    '''
+    Get the minimum and maximum value of an array.
+
+    Params
+    --------
+    component: Union[np.ndarray, List, Tuple]
+        1-D array
+    perc: Union[List[Float], Tuple[Float]]
+        clip the values by the percentiles
+    is_sorted: Bool, optional (default: `False`)
+        whether the component is already sorted,
+        if `True`, min and max are the first and last
+        elements respectively
+
+    Returns
+    --------
+    min_max: Tuple[Float, Float]
+        minimum and maximum values that are not NaN
     '''
     if perc is not None:
         assert len(perc) == 2, 'Percentile must be of length 2.'
         component = np.clip(component, *np.percentile(component, sorted(perc)))
 
-    return (np.nanmin(component), np.nanmax(component)) if not is_sorted else (component[0], component[-1])
+    return (np.nanmin(component), np.nanmax(component)) if not is_sorted else (component[0], component[-1])
+
+
+class Quantiles:
+    f'''
+    Table of evenly spaced quantiles of an array.
+
+    It's computed once, on first use, afterwards getting the values at any
+    percentiles is constant time, unlike `minmax` with `perc`.
+
+    Params
+    --------
+    values: np.ndarray
+        1-D array, NaNs are ignored
+    size: Int, optional (default: `{QUANTILES_SIZE}`)
+        number of quantiles, the default one is exact for percentiles with step `0.1`
+    '''
+
+    def __init__(self, values, size=QUANTILES_SIZE):
+        self.grid = np.linspace(0, 100, size)
+        self.table = None
+        self._values = values
+
+    @property
+    def nbytes(self):
+        return self.grid.nbytes + get_nbytes(self.table)
+
+    def _build(self):
+        values = np.asarray(self._values, dtype=np.float64)
+        self.table = np.nanpercentile(values, self.grid) if np.any(~np.isnan(values)) \
+            else np.full(len(self.grid), np.nan)
+        self._values = None
+
+    def __call__(self, perc=None):
+        '''
+        Get the values at the percentiles.
+
+        Params
+        --------
+        perc: Union[List[Float], Tuple[Float], NoneType], optional (default: `None`)
+            lower and upper percentile, if `None`, get the minimum and maximum
+
+        Returns
+        --------
+        min_max: Tuple[Float, Float]
+            same as `minmax(values, perc)`
+        '''
+
+        if self.table is None:
+            self._build()
+
+        if perc is None:
+            return self.table[0], self.table[-1]
+
+        assert len(perc) == 2, 'Percentile must be of length 2.'
+        low, high = np.interp(sorted(perc), self.grid, self.table)
+
+        return low, high
+
+
+class CategoryCodes:
+    '''
+    Compact integer codes of categorical values and the order in which to draw them.
+
+    Drawing the observations in `order` is the same as sorting them by category,
+    with the missing values last, without sorting on every redraw.
+
+    Params
+    --------
+    values: Union[np.ndarray, pd.Series, pd.Categorical]
+        1-D array, converted to a categorical if not already categorical
+    ordered: Bool, optional (default: `None`)
+        whether the categorical is ordered, if `None`, keep it as is
+    '''
+
+    def __init__(self, values, ordered=None):
+        values = _as_categorical(values)
+        if ordered is not None:
+            values = values.as_ordered() if ordered else values.as_unordered()
+
+        self.values = values
+        self.categories = self.values.categories
+        self.codes = self.values.codes
+
+        n_cats = len(self.categories)
+        dtype = np.uint8 if n_cats < 2 ** 8 - 1 else np.uint16 if n_cats < 2 ** 16 - 1 else np.uint32
+        # missing values (code `-1`) wrap around to the largest code,
+        # stable sort of small unsigned integers is a radix sort
+        self.order = np.argsort(self.codes.astype(dtype), kind='stable')
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.order.nbytes
+
+
+def _as_categorical(values):
+    if isinstance(values, pd.Series):
+        values = values.values
+
+    return values if isinstance(values, pd.Categorical) else pd.Categorical(values)
+
+
+_CATEGORY_CODES = LRUCache(max_entries=CATEGORY_CODES_MAX_ENTRIES)
+
+
+def category_codes(values, key=None):
+    '''
+    Get the `CategoryCodes` of an array.
+
+    They are computed once per key and fingerprint of the values,
+    the values are only factorized when they're not cached.
+
+    Params
+    --------
+    values: Union[np.ndarray, pd.Series, pd.Categorical]
+        1-D array
+    key: Str, optional (default: `None`)
+        name of the values, e.g. the column in `adata.obs`
+
+    Returns
+    --------
+    codes: CategoryCodes
+        codes of the values
+    '''
+
+    token = (key, fingerprint(values))
+
+    codes = _CATEGORY_CODES.get(token, None)
+    if codes is None:
+        codes = _CATEGORY_CODES[token] = CategoryCodes(values)
+
+    return codes
+
+
+def skip_or_filter(adata, needles, haystack, where='', dtype=None,
+                   skip=False, warn=True, ignore_after=None):
+    '''
+    Find all the needles in a given haystack.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    needles: List[Str]
+        keys to search for
+    haystack: Iterable
+        collection to search, e.g. `adata.obs.keys()`
+    where: Str, optional, default (`''`)
+        attribute of `anndata.AnnData` where to look, e. g. `'obsm'`
+    dtype: Union[Callable, Type]
+        expected datatype of the needles
+    skip: Bool, optional (default: `False`)
+        whether to skip the needles which do not have
+        the expected `dtype`
+    warn: Bool
+        whether to issue a warning if `skip=True`
+    ignore_after: Str, optional (default: `None`)
+        token used for extracting the actual key name
+        from the needle of form `KeyTokenIndex`, neeeded when
+        `where='obsm'`, useful e.g. for extracting specific components
+
+    Returns
+    --------
+    found_needles: List[Str]
+        list of all the needles in haystack
+        if `skip=False`, will throw a `RuntimeError`
+        if the needle's type differs from `dtype`
+    '''
+
+    needles_f = list(map(lambda n: n[:n.find(ignore_after)], needles)) if ignore_after is not None else needles
+    index = key_index(adata) if where in ('obs', 'obsm') and isinstance(adata, anndata.AnnData) else None
+    res = []
+
+    for n, nf in zip(needles, needles_f):
+        if nf not in haystack:
+            msg = f'`{nf}` not found in `adata.{where}.keys()`.'
+            if not skip:
+                assert False, msg
+            if warn:
+                warnings.warn(msg + ' Skipping.')
+            continue
+
+        info = None if index is None else index.resolve(n, where=(where, ))
+        if info is not None:
+            col, val = info, info.first
+        else:
+            col = getattr(adata, where)[nf]
+            val = col[0] if isinstance(col, np.ndarray) else col.iloc[0]  # np.ndarray of pd.DataFrame
+            if n != nf:
+                assert where == 'obsm', f'Indexing is only supported for `adata.obsm`, found {nf} in adata.`{where}`.'
+                _, ix = n.split(ignore_after)
+                assert nf == _, 'Unable to parse input.'
+                val = val[int(ix)]
+
+        msg = None
+        is_tup = isinstance(dtype, tuple)
+        if isinstance(dtype, type) or is_tup:
+            if not isinstance(val, dtype):
+                types = dtype.__name__ if not is_tup else f"Union[{', '.join(map(lambda d: d.__name__, dtype))}]"
+                msg = f'Expected `{nf}` to be of type `{types}`, found  `{type(val).__name__}`.'
+        elif callable(dtype):
+            if not dtype(val):
+                msg = f'`{nf}` did not pass the type checking of `{callable.__name__}`.'
+        else:
+            assert isinstance(dtype, str)
+            if not dtype == col.dtype.name:
+                msg = f'Expected `{nf}` to be of type `{dtype}`, found  `{col.dtype.name}`.'
+
+        if msg is not None:
+            if not skip:
+                raise RuntimeError(msg)
+            if warn:
+                warnings.warn(msg + ' Skipping.')
+            continue
+
+        res.append(n)
+
+    return res
+
+
+class SearchIndex:
+    '''
+    Case-insensitive prefix and substring index over strings.
+
+    Params
+    --------
+    values: Iterable[Str]
+        values to search
+    '''
+
+    def __init__(self, values):
+        self.values = np.array(list(map(str, values)), dtype=object)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def _build(self):
+        # built lazily, on the first search
+        lower = pd.Series(self.values).str.lower().values
+        self._order = np.argsort(lower, kind='mergesort')
+        self._sorted = lower[self._order]
+        # substrings are searched in all the values at once
+        self._joined = '\n'.join(lower)
+        self._starts = np.cumsum([0] + [len(v) + 1 for v in lower[:-1]])
+
+    def search(self, query, top_n=SEARCH_TOP_N):
+        f'''
+        Find the values matching the query.
+
+        Params
+        --------
+        query: Str
+            string to search for
+        top_n: Int, optional (default: `{SEARCH_TOP_N}`)
+            maximum number of results
+
+        Returns
+        --------
+        matches: List[Str]
+            values starting with the query, sorted, followed by
+            the values containing the query, in the original order
+        '''
+
+        query = query.strip().lower()
+        if not query:
+            return self.values[:top_n].tolist()
+
+        if self._sorted is None:
+            self._build()
+
+        start = np.searchsorted(self._sorted, query, side='left')
+        candidates = self._sorted[start:start + top_n]
+        n_prefix = np.sum([c.startswith(query) for c in candidates], dtype=np.int64)
+        res = self.values[self._order[start:start + n_prefix]].tolist()
+
+        pos = self._joined.find(query)
+        while pos != -1 and len(res) < top_n:
+            ix = np.searchsorted(self._starts, pos, side='right') - 1
+            # values starting with the query are already among the prefix matches
+            if pos != self._starts[ix]:
+                res.append(self.values[ix])
+            if ix + 1 == len(self._starts):
+                break
+            pos = self._joined.find(query, self._starts[ix + 1])
+
+        return res
+
+
+class ConditionPicker:
+    f'''
+    Searchable selection widget, useful when there are too many values for a dropdown.
+
+    Only the `top_n` values matching the searched string are sent to the browser.
+
+    Params
+    --------
+    name: Str
+        name of the widget
+    values: Iterable[Str]
+        values to choose from
+    default: Str, optional (default: `None`)
+        initially selected value, if `None`, use the first one
+    top_n: Int, optional (default: `{SEARCH_TOP_N}`)
+        maximum number of options shown at once
+    '''
+
+    def __init__(self, name, values, default=None, top_n=SEARCH_TOP_N):
+        self.index = SearchIndex(values)
+        self.top_n = top_n
+
+        options = self.index.search('', top_n)
+        default = options[0] if default is None else str(default)
+        if default not in options:
+            options = [default] + options[:top_n - 1]
+
+        self.search = pn.widgets.TextInput(name=f'Search {name.lower()}', placeholder=f'{len(self.index)} values')
+        self.select = pn.widgets.Select(name=name, options=options, value=default)
+        self.widget = pn.Column(self.search, self.select)
+
+        # update on each keystroke, if supported
+        self.search.param.watch(self._update_options, 'value_input' if 'value_input' in self.search.param else 'value')
+
+    @property
+    def value(self):
+        return self.select.value
+
+    def _update_options(self, event):
+        options = self.index.search(event.new or '', self.top_n)
+        # don't change the selection while searching
+        if self.value not in options:
+            options = [self.value] + options[:self.top_n - 1]
+        self.select.options = options
+
+    def watch(self, fn):
+        '''
+        Call a function when the selected value changes.
+
+        Params
+        --------
+        fn: Callable
+            function called with the newly selected value
+
+        Returns
+        --------
+        None
+            nothing, just registers the function
+        '''
+
+        self.select.param.watch(lambda event: fn(event.new), 'value')
+
+
+def kwarg_as_arg(fn, pos, name):
+    '''
+    Pass a keyword argument of a function as a positional one,
+    e.g. to supply a `hv.DynamicMap` key dimension through a stream instead.
+
+    Params
+    --------
+    fn: Callable
+        function to wrap
+    pos: Int
+        position of the argument in `fn`
+    name: Str
+        name of the keyword argument
+
+    Returns
+    --------
+    wrapped: Callable
+        function which accepts `name` as keyword argument
+    '''
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        value = kwargs.pop(name)
+        return fn(*args[:pos], value, *args[pos:], **kwargs)
+
+    return inner
+
+
+def _add_widgets(res, widgets, reverse):
+    # res is `pn.Row` of the plot and its widgets, if any
+    if not len(widgets):
+        return res
+
+    if hasattr(res, 'reverse'):
+        box = res[0] if reverse else res[-1]
+        # the objects of a layout must be panel objects, raw bokeh widgets are wrapped
+        box.objects = [pn.panel(w) for w in widgets] + list(box.objects)
+        return res
+
+    box = pn.WidgetBox(*widgets)
+
+    return pn.Row(box, res) if reverse else pn.Row(res, box)
+
+
+def has_attributes(*args, **kwargs):
+    '''
+    Params
+    --------
+    *args: variable length arguments
+        key to check in for 
+    **kwargs: keyword arguments
+        attributes to check, keys will be interpreted
+        as arguments in function signature to check
+        and values are lists annotated as follows:
+        `[<optional_dtype>, 'a:<attribute1>', '<key1>', '<key2>', 'a:<attribute2>', ...]`
+        using type `None` will result in no type checking
+
+    Returns
+    --------
+    wrapped: Callable
+        function, which does the checks at runtime
+    --------
+    '''
+
+    def inner(fn):
+        '''
+        Binds the arguments of the function and checks the types.
+
+        Params
+        --------
+        fn: Callable
+            function to wrap
+
+        Returns
+        --------
+        wrapped: Callable
+            the wrapped function
+        '''
+
+        @wraps(fn)
+        def inner2(*fargs, **fkwargs):
+            bound = sig.bind(*fargs, **fkwargs)
+            bound.apply_defaults()
+
+            for k, v in kwargs.items():
+                if isinstance(v, type) or istype(v):
+                    assert isinstance(bound.arguments[k], v), f'Argument: `{k}` must be of type: `{v}`.'
+                elif iterable(v):
+                    if not iterable(v[0]):
+                        v = [v]
+
+                    for vals in v:
+                        typp = None
+                        if vals[0] is None or istype(vals[0]):
+                            typp, *vals = vals
+                        if not vals[0].startswith('a:'):
+                            raise ValueError('The first element must be an attribute '
+                                             f'annotated with: `a:`, found: `{vals[0]}`. '
+                                             f'Consider using: `a:{vals[0]}`.')
+
+                        obj = None
+                        for val in vals:
+                            if val.startswith('a:'):
+                                obj = getattr(obj if obj is not None else bound.arguments[k], val[2:])
+                            else:
+                                assert obj is not None
+                                obj = obj[val]
+
+                        if typp is not None:
+                            assert isinstance(obj, typp)
+                else:
+                    raise RuntimeError(f'Unable to decode invariant: `{k}={v}`.')
+
+            return fn(*fargs, **fkwargs)
+
+        sig = signature(fn)
+        for param in tuple(kwargs.keys()) + args:
+            if not param in sig.parameters.keys():
+                raise ValueError(f'Parameter `{param}` not found in the signature.')
+
+        return inner2
+
+    return inner
+
+
+def wrap_as_panel(fn):
+    '''
+    Wrap the widget inside a panel.
+
+    Params
+    --------
+    fn: Callable
+        funtion that returns a plot, such as `scatter`,
+        or a tuple of the plot and additional widgets
+    
+    Returns
+    --------
+    wrapper: Callable
+        function which return object of type `pn.panel`
+    '''
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        reverse = kwargs.pop('reverse', True)
+        res = fn(*args, **kwargs)
+        if res is None:
+            return None
+
+        res, widgets = res if isinstance(res, tuple) else (res, [])
+        res = pn.panel(res)
+        if reverse and hasattr(res, 'reverse'):
+            res.reverse()
+
+        return _add_widgets(res, widgets, reverse)
+
+    return inner
+
+
+def wrap_as_col(fn):
+    '''
+    Wrap the widget in a column, having it's
+    input in one row.
+
+    Params
+    --------
+    fn: Callable
+        funtion that returns a plot, such as `dpt`,
+        or a tuple of the plot and additional widgets
+    
+    Returns
+    --------
+    wrapped: Callable 
+        function which return object of type `pn.Column`
+    '''
+
+    def chunkify(l, n):
+        for i in range(0, len(l), n):
+            yield l[i: i + n]
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        reverse = kwargs.pop('reverse', True)
+        res = fn(*args, **kwargs)
+        if res is None:
+            return None
+
+        res, extra_widgets = res if isinstance(res, tuple) else (res, [])
+        res = pn.panel(res)
+        if reverse and hasattr(res, 'reverse'):
+            res.reverse()
+        res = _add_widgets(res, extra_widgets, reverse)
+
+        widgets = list(map(lambda w: pn.Row(*w), filter(len, chunkify(res[0], 3))))
+        return pn.Column(*(widgets + [res[1]]))
+
+    return inner
+
+
+def obsm_column(arr, ix):
+    '''
+    Get a column of an array in `adata.obsm` as a dense 1-D array.
+
+    Params
+    --------
+    arr: Union[np.ndarray, scipy.sparse.spmatrix]
+        array of shape `(n_obs, n_components)`
+    ix: Int
+        index of the column
+
+    Returns
+    --------
+    column: np.ndarray
+        array of shape `(n_obs,)`
+    '''
+
+    col = arr[:, ix]
+
+    return col.toarray().ravel() if issparse(col) else np.asarray(col)
+
+
+def get_data(adata, needle, ignore_after=OBSM_SEP, haystacks=['obs', 'obsm', 'var_names']):
+    f'''
+    Search for a needle in multiple haystacks.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    needle: Str
+        needle to search for
+    ignore_after: Str, optional (default: `'{OBSM_SEP}'`)
+        token used for extracting the actual key name
+        from the needle of form `KeyTokenIndex`, neeeded
+        when `'obsm' in haystacks`, useful e.g. for extracting specific components
+    haystack: List[Str], optional (default: `['obs', 'obsm', 'var_names']`)
+        attributes of `anndata.AnnData`
+
+    Returns
+    --------
+    (result, is_categorical): Tuple[Object, Bool]
+        the found object and whether it's categorical
+    '''
+
+    if isinstance(adata, anndata.AnnData) and ignore_after == OBSM_SEP:
+        info = key_index(adata).resolve(needle, where=tuple(haystacks))
+        if info is not None:
+            if info.where == 'obs':
+                return adata.obs[info.key], info.is_categorical
+            if info.where == 'var_names':
+                return gene_vector(adata, info.key), False
+            if info.ix is not None:
+                return obsm_column(adata.obsm[info.key], info.ix), False
+        # the slow path below handles the errors
+
+    for haystack in haystacks:
+        obj = getattr(adata, haystack)
+        if ignore_after in needle and haystack == 'obsm':
+            k, ix = needle.split(ignore_after)
+            ix = int(ix)
+        else:
+            k, ix = needle, None
+
+        if k in obj:
+            res = obj[k] if haystack != 'var_names' else gene_vector(adata, k)
+            if ix is not None:
+                assert res.ndim == 2, f'`adata.{haystack}[{k}]` must have a dimension of 2, found `{res.dim}`.'
+                assert res.shape[-1] > ix, f'Index `{ix}` out of bounds for `adata.{haystack}[{k}]` of shape `{res.shape}`.'
+                res = obsm_column(res, ix)
+            if res.shape != (adata.n_obs, ):
+                msg = f'`{needle}` in `adata.{haystack}` has wrong shape of `{res.shape}`.'
+                if haystack == 'obsm':
+                    msg += f' Try using `{needle}{OBSM_SEP}ix`, 0 <= `ix` < {res.shape[-1]}.'
+                raise ValueError(msg)
+
+            return res, is_categorical(res)
+
+    raise ValueError(f'Unable to find `{needle}` in `adata.{haystacks}`.')
+
+
+def get_all_obsm_keys(adata, ixs):
+    if not isinstance(ixs, (tuple, list)):
+        ixs = [ixs]
+
+    assert all(map(lambda ix: ix >= 0, ixs)), f'All indices must be non-negative.'
+
+    return list(itertools.chain.from_iterable((f'{key}{OBSM_SEP}{ix}'
+                                          for key in adata.obsm.keys() if isinstance(adata.obsm[key], np.ndarray) and adata.obsm[key].ndim == 2 and adata.obsm[key].shape[-1] > ix)
+                                          for ix in ixs))
+def get_connectivities(adata):
+    '''
+    Get the connectivities of the neighbors graph.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+
+    Returns
+    --------
+    connectivities: Union[scipy.sparse.spmatrix, NoneType]
+        the connectivities or `None` if `sc.pp.neighbors` was not run
+    '''
+
+    obsp = getattr(adata, 'obsp', {})
+    if 'connectivities' in obsp.keys():
+        return obsp['connectivities']
+
+    return adata.uns.get('neighbors', {}).get('connectivities', None)
+
+
+class DiffusionPseudotime:
+    f'''
+    Diffusion pseudotime computed from a stored diffusion map.
+
+    Same as `sc.tl.dpt` with `n_branchings=0`: the pseudotime from a root is
+    its distance to the other cells in the diffusion map, whose components are scaled
+    by `eval / (1 - eval)`, except for the stationary ones, normalized by the maximum.
+    The scaled components are computed once, the pseudotime from a root then costs `O(n_obs * n_dcs)`.
+    A batch of roots is computed in blocks of cells, from the differences of the coordinates,
+    so that the result is the same as for a single root.
+
+    Params
+    --------
+    evecs: np.ndarray
+        diffusion components, such as `adata.obsm['X_diffmap']`
+    evals: np.ndarray
+        their eigenvalues, such as `adata.uns['diffmap_evals']`
+    n_dcs: Int, optional (default: `{DPT_N_DCS}`)
+        number of diffusion components to use
+    labels: np.ndarray, optional (default: `None`)
+        connected component of each cell, the pseudotime to cells in other components is `inf`
+    '''
+
+    def __init__(self, evecs, evals, n_dcs=DPT_N_DCS, labels=None):
+        assert n_dcs <= len(evals), f'Expected `n_dcs` to be at most `{len(evals)}`, found `{n_dcs}`.'
+        evecs = np.asarray(evecs, dtype=np.float64)[:, :n_dcs]
+        evals = np.asarray(evals, dtype=np.float64)[:n_dcs]
+
+        # same threshold as `scanpy`, the stationary components are not scaled
+        mask = evals < DPT_EVAL_THRESH
+        self.coords = np.ascontiguousarray(np.hstack([evecs[:, mask] * (evals[mask] / (1 - evals[mask])),
+                                                      evecs[:, ~mask]]))
+        self.labels = None if labels is None or len(np.unique(labels)) < 2 else np.asarray(labels)
+
+    @property
+    def n_obs(self):
+        return len(self.coords)
+
+    @property
+    def nbytes(self):
+        return self.coords.nbytes + get_nbytes(self.labels)
+
+    def _normalize(self, dists, roots):
+        if self.labels is not None:
+            dists[self.labels[roots][:, None] != self.labels[None, :]] = np.inf
+
+        finite = np.where(np.isfinite(dists), dists, -np.inf)
+        maxx = np.max(finite, axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dists /= maxx
+
+        return dists
+
+    def __call__(self, roots):
+        '''
+        Get the pseudotime from root cells.
+
+        Params
+        --------
+        roots: Union[Int, Sequence[Int]]
+            index of a root cell or indices of multiple root cells
+
+        Returns
+        --------
+        pseudotime: np.ndarray
+            pseudotime of all the cells, of shape `(n_obs,)` for a single root
+            or `(len(roots), n_obs)` for multiple roots
+        '''
+
+        if np.ndim(roots) == 0:
+            diff = self.coords - self.coords[roots]
+            dists = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+            return self._normalize(dists[None, :], np.array([roots]))[0]
+
+        roots = np.asarray(roots, dtype=np.int64)
+        origins = self.coords[roots]
+        dists = np.empty((len(roots), self.n_obs), dtype=np.float64)
+
+        # not `|a|^2 + |b|^2 - 2ab`, which cancels catastrophically for nearby cells
+        step = max(1, DPT_BLOCK_SIZE // max(1, len(roots) * self.coords.shape[1]))
+        for start in range(0, self.n_obs, step):
+            diff = origins[:, None, :] - self.coords[None, start:start + step, :]
+            dists[:, start:start + step] = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+        return self._normalize(dists, roots)
+
+    def chunks(self, roots=None, chunk_size=DPT_CHUNK_SIZE):
+        f'''
+        Get the pseudotime from many root cells, few at a time.
+
+        Params
+        --------
+        roots: Sequence[Int], optional (default: `None`)
+            indices of the root cells, if `None`, use all the cells
+        chunk_size: Int, optional (default: `{DPT_CHUNK_SIZE}`)
+            number of root cells in each chunk
+
+        Returns
+        --------
+        chunks: Iterator[Tuple[np.ndarray, np.ndarray]]
+            indices of the root cells and their pseudotime of shape `(chunk_size, n_obs)`
+        '''
+
+        roots = np.arange(self.n_obs) if roots is None else np.asarray(roots, dtype=np.int64)
+        for start in range(0, len(roots), chunk_size):
+            chunk = roots[start:start + chunk_size]
+            yield chunk, self(chunk)
+
+
+_DPT_CACHE = LRUCache(max_entries=DPT_CACHE_MAX_ENTRIES)
+
+
+def diffusion_pseudotime(adata, n_dcs=DPT_N_DCS):
+    f'''
+    Get the `DiffusionPseudotime` of an `anndata.AnnData` object.
+
+    It is built once per diffusion map and neighbors graph.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    n_dcs: Int, optional (default: `{DPT_N_DCS}`)
+        number of diffusion components to use
+
+    Returns
+    --------
+    dpt: Union[DiffusionPseudotime, NoneType]
+        the pseudotime or `None` if `adata` doesn't contain at least
+        `n_dcs` diffusion components, e.g. when `sc.tl.diffmap` was not run
+    '''
+
+    if 'X_diffmap' not in adata.obsm.keys() or 'diffmap_evals' not in adata.uns.keys():
+        return None
+
+    evecs, evals = adata.obsm['X_diffmap'], adata.uns['diffmap_evals']
+    if n_dcs > min(evecs.shape[1], len(evals)):
+        return None
+
+    conns = get_connectivities(adata)
+    key = (fingerprint(evecs), fingerprint(evals), None if conns is None else fingerprint(conns), n_dcs)
+    dpt = _DPT_CACHE.get(key, None)
+    if dpt is None:
+        # as in `scanpy`, only sparse connectivities are split into components
+        labels = connected_components(conns)[1] if issparse(conns) else None
+        dpt = _DPT_CACHE[key] = DiffusionPseudotime(evecs, evals, n_dcs=n_dcs, labels=labels)
+
+    return dpt
+
+
+_KD_TREES = LRUCache(max_entries=KD_TREE_CACHE_MAX_ENTRIES)
+
+
+def nearest_obs(adata, bs, components, x, y, ixs=None):
+    '''
+    Find the observation closest to a point in an embedding.
+
+    The KD-tree is built once per basis, components and subset of observations.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    bs: Str
+        basis in `adata.obsm`
+    components: Tuple[Int, Int]
+        components of the basis
+    x: Float
+        first coordinate of the point
+    y: Float
+        second coordinate of the point
+    ixs: np.ndarray, optional (default: `None`)
+        indices of the observations to search, if `None`, search all of them
+
+    Returns
+    --------
+    ix: Int
+        index of the closest observation in `adata`
+    '''
+
+    emb = adata.obsm[f'X_{bs}']
+    components = tuple(map(int, components))
+    key = (fingerprint(emb), components, None if ixs is None else fingerprint(ixs))
+
+    tree = _KD_TREES.get(key, None)
+    if tree is None:
+        coords = emb[:, components] if ixs is None else emb[ixs][:, components]
+        tree = _KD_TREES[key] = cKDTree(np.asarray(coords, dtype=np.float64))
+
+    _, ix = tree.query([x, y])
+
+    return int(ix if ixs is None else ixs[ix])
+
+
+_CACHE_DIR = os.environ.get('INTERACTIVE_PLOTTING_CACHE_DIR', None)
+
+
+def set_cache_dir(path):
+    f'''
+    Set the directory where to persist the samples and densities.
+
+    Params
+    --------
+    path: Union[os.PathLike, Str, NoneType]
+        the cache directory, if `None`, only the data of backed objects
+        will be cached, in `'{CACHE_DIR_NAME}'` next to their file
+
+    Returns
+    --------
+    None
+        nothing, just sets the directory
+    '''
+
+    global _CACHE_DIR
+    _CACHE_DIR = None if path is None else str(path)
+
+
+def get_cache_dir(adata=None, cache_dir=None):
+    f'''
+    Get the directory where to persist the samples and densities.
+
+    Params
+    --------
+    adata: anndata.AnnData, optional (default: `None`)
+        anndata object
+    cache_dir: Union[os.PathLike, Str, Bool, NoneType], optional (default: `None`)
+        if `False`, disable the persistence, if `None`, use the directory
+        set by `set_cache_dir` or environment variable `INTERACTIVE_PLOTTING_CACHE_DIR`,
+        otherwise directory `'{CACHE_DIR_NAME}'` next to the file of `adata`;
+        only backed objects know their file, so for objects loaded into memory,
+        nothing is persisted unless a directory is set
+
+    Returns
+    --------
+    cache_dir: Union[Str, NoneType]
+        the cache directory or `None` if nothing should be persisted
+    '''
+
+    if cache_dir is False:
+        return None
+    if cache_dir is not None:
+        return str(cache_dir)
+    if _CACHE_DIR is not None:
+        return _CACHE_DIR
+
+    # `adata.filename` is only set for backed objects
+    if not getattr(adata, 'isbacked', False) or adata.filename is None:
+        return None
+
+    return os.path.join(os.path.dirname(os.path.abspath(str(adata.filename))), CACHE_DIR_NAME)
+
+
+def _cache_file(cache_dir, name, data, **params):
+    # the whole buffer is hashed, sampled fingerprints can't tell apart embeddings across sessions
+    digest = hashlib.sha1()
+    arrays = [getattr(data, attr) for attr in ('data', 'indices', 'indptr')] if issparse(data) else [data]
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        digest.update(repr((arr.shape, arr.dtype.str)).encode())
+        digest.update(memoryview(arr).cast('B'))
+    digest.update(repr((data.shape, sorted(params.items()))).encode())
+
+    return os.path.join(cache_dir, f'{name}_{digest.hexdigest()}.npz')
+
+
+def _load_cached(path, key):
+    if path is None or not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(path) as fin:
+            return fin[key]
+    except (OSError, KeyError, ValueError) as e:
+        warnings.warn(f'Unable to load `{path}`: `{e}`.')
+
+    return None
+
+
+def _save_cached(path, **arrays):
+    if path is None:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that other sessions never read partial files
+        tmp = f'{path[:-len(".npz")]}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+    except OSError as e:
+        warnings.warn(f'Unable to save `{path}`: `{e}`.')
+
+
+def parallel_map(fn, args, n_jobs=1, progress=None):
+    '''
+    Lazily apply a function to each tuple of arguments using a thread pool.
+
+    The results are yielded in order, as soon as they're ready.
+    At most `2 * n_jobs` results are computed ahead of the consumer.
+
+    Params
+    --------
+    fn: Callable
+        function to apply
+    args: Iterable[Tuple]
+        positional arguments for each call
+    n_jobs: Int, optional (default: `1`)
+        number of threads, if `< 1`, use all the available cores
+        if `1`, everything is run in the calling thread
+    progress: Callable, optional (default: `None`)
+        called as `progress(n_done, n_total)` after each finished call
+
+    Returns
+    --------
+    results: Iterator
+        the results, in the same order as `args`
+    '''
+
+    args = list(args)
+    n_total = len(args)
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+
+    if n_jobs == 1:
+        for i, arg in enumerate(args):
+            res = fn(*arg)
+            if progress is not None:
+                progress(i + 1, n_total)
+            yield res
+
+        return
+
+    todo = iter(enumerate(args))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        pending, done = dict(), dict()
+
+        def submit():
+            # finished results waiting for the consumer count as well
+            while len(pending) + len(done) < 2 * n_jobs:
+                i, arg = next(todo, (None, None))
+                if i is None:
+                    return
+                pending[executor.submit(fn, *arg)] = i
+
+        submit()
+        n_done, n_yielded = 0, 0
+        while n_yielded < n_total:
+            if n_yielded not in done:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done[pending.pop(future)] = future.result()
+                    n_done += 1
+                    if progress is not None:
+                        progress(n_done, n_total)
+                continue
+
+            res = done.pop(n_yielded)
+            n_yielded += 1
+            submit()
+            yield res
+
+
+def _group_argmin(groups, values, n_groups):
+    '''
+    Find the observation with the smallest value in each group.
+
+    Params
+    --------
+    groups: np.ndarray
+        group index for each observation, in `[0, n_groups)`
+    values: np.ndarray
+        values to minimize within each group
+    n_groups: Int
+        total number of groups
+
+    Returns
+    --------
+    ixs: np.ndarray
+        sorted indices of the representative observations,
+        one per non-empty group, ties are broken by the smaller index
+    '''
+
+    n_obs = len(groups)
+    best = np.full(n_groups, np.inf)
+    np.minimum.at(best, groups, values)
+
+    cands, = np.where(values == best[groups])
+    first = np.full(n_groups, n_obs)
+    np.minimum.at(first, groups[cands], cands)
+
+    mask = np.zeros(n_obs, dtype=np.bool_)
+    mask[first[first < n_obs]] = True
+
+    return np.flatnonzero(mask)
 
 
-def skip_or_filter(adata, needles, haystack, where='', dtype=None,
-                   skip=False, warn=True, ignore_after=None):
+def grid_bins(embedding, steps):
     '''
-    Find all the needles in a given haystack.
+    Assign each observation to the closest point of a regular grid.
 
     Params
     --------
-    adata: anndata.AnnData
-        anndata object
-    needles: List[Str]
-        keys to search for
-    haystack: Iterable
-        collection to search, e.g. `adata.obs.keys()`
-    where: Str, optional, default (`''`)
-        attribute of `anndata.AnnData` where to look, e. g. `'obsm'`
-    dtype: Union[Callable, Type]
-        expected datatype of the needles
-    skip: Bool, optional (default: `False`)
-        whether to skip the needles which do not have
-        the expected `dtype`
-    warn: Bool
-        whether to issue a warning if `skip=True`
-    ignore_after: Str, optional (default: `None`)
-        token used for extracting the actual key name
-        from the needle of form `KeyTokenIndex`, neeeded when
-        `where='obsm'`, useful e.g. for extracting specific components
+    embedding: np.ndarray
+        array of shape `(n_obs, n_dim)`
+    steps: Union[Int, List[Int]]
+        number of grid points in each dimension
 
     Returns
     --------
-    found_needles: List[Str]
-        list of all the needles in haystack
-        if `skip=False`, will throw a `RuntimeError`
-        if the needle's type differs from `dtype`
+    (bins, dist, n_bins): Tuple[np.ndarray, np.ndarray, Int]
+        flat index of the closest grid point, distance to it
+        and the total number of grid points
     '''
 
-    needles_f = list(map(lambda n: n[:n.find(ignore_after)], needles)) if ignore_after is not None else needles
-    res = []
+    n_dim = embedding.shape[1]
+    if not isinstance(steps, (tuple, list, np.ndarray)):
+        steps = [steps] * n_dim
+    steps = np.asarray(steps, dtype=np.int64)
+    assert len(steps) == n_dim, f'Expected `{n_dim}` steps, found `{len(steps)}`.'
+    assert np.all(steps > 0), 'All steps must be positive.'
 
-    for n, nf in zip(needles, needles_f):
-        if nf not in haystack:
-            msg = f'`{nf}` not found in `adata.{where}.keys()`.'
-            if not skip:
-                assert False, msg
-            if warn:
-                warnings.warn(msg + ' Skipping.')
-            continue
+    m, M = np.min(embedding, axis=0), np.max(embedding, axis=0)
+    m = m - 0.025 * np.abs(M - m)
+    M = M + 0.025 * np.abs(M - m)
+    delta = (M - m) / np.maximum(steps - 1, 1)
+    delta[delta == 0] = 1
 
-        col = getattr(adata, where)[nf]
-        val = col[0] if isinstance(col, np.ndarray) else col.iloc[0]  # np.ndarray of pd.DataFrame
-        if n != nf:
-            assert where == 'obsm', f'Indexing is only supported for `adata.obsm`, found {nf} in adata.`{where}`.'
-            _, ix = n.split(ignore_after)
-            assert nf == _, 'Unable to parse input.'
-            val = val[int(ix)]
+    coords = np.clip(np.rint((embedding - m) / delta), 0, steps - 1).astype(np.int64)
+    dist = np.linalg.norm(embedding - (m + coords * delta), axis=1)
 
-        msg = None
-        is_tup = isinstance(dtype, tuple)
-        if isinstance(dtype, type) or is_tup:
-            if not isinstance(val, dtype):
-                types = dtype.__name__ if not is_tup else f"Union[{', '.join(map(lambda d: d.__name__, dtype))}]"
-                msg = f'Expected `{nf}` to be of type `{types}`, found  `{type(val).__name__}`.'
-        elif callable(dtype):
-            if not dtype(val):
-                msg = f'`{nf}` did not pass the type checking of `{callable.__name__}`.'
-        else:
-            assert isinstance(dtype, str)
-            if not dtype == col.dtype.name:
-                msg = f'Expected `{nf}` to be of type `{dtype}`, found  `{col.dtype.name}`.'
+    bins = np.ravel_multi_index(tuple(coords.T), tuple(steps))
+    n_bins = int(np.prod(steps))
 
-        if msg is not None:
-            if not skip:
-                raise RuntimeError(msg)
-            if warn:
-                warnings.warn(msg + ' Skipping.')
-            continue
+    if n_bins > len(bins):
+        # too many empty grid points, only keep the occupied ones
+        _, bins = np.unique(bins, return_inverse=True)
+        n_bins = int(np.max(bins)) + 1 if len(bins) else 0
 
-        res.append(n)
+    return bins, dist, n_bins
 
-    return res
 
+def _sampled(adata, ixs, copy=False):
+    view = SampledView(adata, ixs)
 
-def has_attributes(*args, **kwargs):
+    return view.to_adata() if copy else view
+
+
+# based on:
+# https://github.com/velocyto-team/velocyto-notebooks/blob/master/python/DentateGyrus.ipynb
+def sample_unif(adata, steps, bs='umap', components=(0, 1), cache_dir=None, copy=False):
     '''
+    Uniformly sample the embedding by choosing one cell per grid point.
+
+    Each cell is binned to its closest grid point and the cell closest
+    to the grid point is chosen as its representative. This is done
+    in a single vectorized pass, without any nearest neighbor queries.
+
     Params
     --------
-    *args: variable length arguments
-        key to check in for 
-    **kwargs: keyword arguments
-        attributes to check, keys will be interpreted
-        as arguments in function signature to check
-        and values are lists annotated as follows:
-        `[<optional_dtype>, 'a:<attribute1>', '<key1>', '<key2>', 'a:<attribute2>', ...]`
-        using type `None` will result in no type checking
+    adata: anndata.AnnData
+        anndata object
+    steps: Union[Int, List[Int]]
+        number of grid points in each dimension
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm`
+    components: List[Int], optional (default: `(0, 1)`)
+        components of the basis to use
+    cache_dir: Union[os.PathLike, Str, Bool, NoneType], optional (default: `None`)
+        directory where to persist the indices, see `get_cache_dir`
+    copy: Bool, optional (default: `False`)
+        whether to return a copy of `adata` instead of `SampledView`
 
     Returns
     --------
-    wrapped: Callable
-        function, which does the checks at runtime
-    --------
+    (adata, ixs): Tuple[Union[SampledView, anndata.AnnData], np.ndarray]
+        the subsampled object and the sorted indices of the representative cells
     '''
 
-    def inner(fn):
-        '''
-        Binds the arguments of the function and checks the types.
+    assert len(components)
+    assert min(components) >= 0
 
-        Params
-        --------
-        fn: Callable
-            function to wrap
+    embedding = adata.obsm[f'X_{bs}'][:, components]
 
-        Returns
-        --------
-        wrapped: Callable
-            the wrapped function
-        '''
+    cache_dir = get_cache_dir(adata, cache_dir)
+    path = None if cache_dir is None else \
+        _cache_file(cache_dir, 'unif', embedding, steps=tuple(np.ravel(steps).tolist()))
 
-        @wraps(fn)
-        def inner2(*fargs, **fkwargs):
-            bound = sig.bind(*fargs, **fkwargs)
-            bound.apply_defaults()
+    ixs = _load_cached(path, 'ixs')
+    if ixs is None:
+        bins, dist, n_bins = grid_bins(embedding, steps)
+        ixs = _group_argmin(bins, dist, n_bins)
+        _save_cached(path, ixs=ixs)
 
-            for k, v in kwargs.items():
-                if isinstance(v, type) or istype(v):
-                    assert isinstance(bound.arguments[k], v), f'Argument: `{k}` must be of type: `{v}`.'
-                elif iterable(v):
-                    if not iterable(v[0]):
-                        v = [v]
+    return _sampled(adata, ixs, copy=copy), ixs
 
-                    for vals in v:
-                        typp = None
-                        if vals[0] is None or istype(vals[0]):
-                            typp, *vals = vals
-                        if not vals[0].startswith('a:'):
-                            raise ValueError('The first element must be an attribute '
-                                             f'annotated with: `a:`, found: `{vals[0]}`. '
-                                             f'Consider using: `a:{vals[0]}`.')
 
-                        obj = None
-                        for val in vals:
-                            if val.startswith('a:'):
-                                obj = getattr(obj if obj is not None else bound.arguments[k], val[2:])
-                            else:
-                                assert obj is not None
-                                obj = obj[val]
+def _binned_density(embedding, factor, grid_size):
+    n_obs, n_dim = embedding.shape
+    m, M = np.min(embedding, axis=0), np.max(embedding, axis=0)
+    delta = (M - m) / (grid_size - 1)
+    delta[delta == 0] = 1
 
-                        if typp is not None:
-                            assert isinstance(obj, typp)
-                else:
-                    raise RuntimeError(f'Unable to decode invariant: `{k}={v}`.')
+    coords = np.rint((embedding - m) / delta).astype(np.int64)
+    bins = np.ravel_multi_index(tuple(coords.T), (grid_size, ) * n_dim)
+    hist = np.bincount(bins, minlength=grid_size ** n_dim).reshape((grid_size, ) * n_dim).astype(np.float64)
 
-            return fn(*fargs, **fkwargs)
+    # gaussian kernel, diagonal approximation of `scipy.stats.gaussian_kde`
+    sigma = factor * np.std(embedding, axis=0, ddof=1) / delta
+    smoothed = gaussian_filter(hist, sigma=sigma, mode='constant')
 
-        sig = signature(fn)
-        for param in tuple(kwargs.keys()) + args:
-            if not param in sig.parameters.keys():
-                raise ValueError(f'Parameter `{param}` not found in the signature.')
+    return smoothed.ravel()[bins]
 
-        return inner2
 
-    return inner
+def _exact_density(embedding, bandwidth):
+    from scipy.stats import gaussian_kde
 
+    return gaussian_kde(embedding.T, bw_method=bandwidth)(embedding.T)
 
-def wrap_as_panel(fn):
-    '''
-    Wrap the widget inside a panel.
+
+def embedding_density(adata, bs='umap', components=(0, 1), bandwidth=None,
+                      method='exact', grid_size=DENSITY_GRID_SIZE, cache_dir=None):
+    f'''
+    Estimate the density of cells in an embedding.
+
+    The densities are cached for each embedding, components, bandwidth
+    and method, and are never written to `adata.obs`. If a cache directory
+    is available, they are also persisted across sessions.
 
     Params
     --------
-    fn: Callable
-        funtion that returns a plot, such as `scatter`
-    
+    adata: anndata.AnnData
+        anndata object
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm`
+    components: List[Int], optional (default: `(0, 1)`)
+        components of the basis to use
+    bandwidth: Float, optional (default: `None`)
+        bandwidth factor of the gaussian kernel, relative to the standard deviation,
+        if `None`, use Scott's rule, same as `scipy.stats.gaussian_kde`
+    method: Str, optional (default: `'exact'`)
+        if `'exact'`, use `scipy.stats.gaussian_kde`, same as `scanpy`, which is quadratic
+        in the number of cells, if `'binned'`, bin the cells into a grid and smooth it
+        with a gaussian filter, which is linear, but only approximates the density
+    grid_size: Int, optional (default: `{DENSITY_GRID_SIZE}`)
+        number of bins in each dimension, used when `method='binned'`
+    cache_dir: Union[os.PathLike, Str, Bool, NoneType], optional (default: `None`)
+        directory where to persist the densities, see `get_cache_dir`
+
     Returns
     --------
-    wrapper: Callable
-        function which return object of type `pn.panel`
+    density: np.ndarray
+        density of each cell, scaled to `[0, 1]`
     '''
 
-    @wraps(fn)
-    def inner(*args, **kwargs):
-        reverse = kwargs.pop('reverse', True)
-        res = fn(*args, **kwargs)
-        if res is None:
-            return None
-
-        res = pn.panel(res)
-        if reverse and hasattr(res, 'reverse'):
-            res.reverse()
-
-        return res
+    assert method in ('binned', 'exact'), f'Invalid method `{method}`. Possible values are `\'binned\', \'exact\'`.'
+    assert grid_size > 1, f'`grid_size` must be `> 1`, found `{grid_size}`.'
 
-    return inner
+    bs_key = f'X_{bs}'
+    assert bs_key in adata.obsm.keys(), f'`{bs_key}` not found in `adata.obsm`.'
 
+    data = adata.obsm[bs_key]
+    key = (fingerprint(data), tuple(components), bandwidth, method, grid_size)
 
-def wrap_as_col(fn):
-    '''
-    Wrap the widget in a column, having it's
-    input in one row.
+    density = _DENSITY_CACHE.get(key, None)
+    if density is not None:
+        return density
 
-    Params
-    --------
-    fn: Callable
-        funtion that returns a plot, such as `dpt`
-    
-    Returns
-    --------
-    wrapped: Callable 
-        function which return object of type `pn.Column`
-    '''
+    embedding = np.asarray(data[:, components], dtype=np.float64)
+    n_obs, n_dim = embedding.shape
 
-    def chunkify(l, n):
-        for i in range(0, len(l), n):
-            yield l[i: i + n]
+    cache_dir = get_cache_dir(adata, cache_dir)
+    path = None if cache_dir is None else \
+        _cache_file(cache_dir, 'density', embedding, bandwidth=bandwidth, method=method, grid_size=grid_size)
 
-    @wraps(fn)
-    def inner(*args, **kwargs):
-        reverse = kwargs.pop('reverse', True)
-        res = fn(*args, **kwargs)
-        if res is None:
-            return None
+    density = _load_cached(path, 'density')
+    if density is None:
+        if method == 'exact':
+            density = _exact_density(embedding, bandwidth)
+        else:
+            factor = n_obs ** (-1 / (n_dim + 4)) if bandwidth is None else bandwidth
+            density = _binned_density(embedding, factor, grid_size)
 
-        res = pn.panel(res)
-        if reverse and hasattr(res, 'reverse'):
-            res.reverse()
+        minn, maxx = np.min(density), np.max(density)
+        density = (density - minn) / ((maxx - minn) if maxx > minn else 1)
+        _save_cached(path, density=density)
 
-        widgets = list(map(lambda w: pn.Row(*w), filter(len, chunkify(res[0], 3))))
-        return pn.Column(*(widgets + [res[1]]))
+    _DENSITY_CACHE[key] = density
 
-    return inner
+    return density
 
 
-def get_data(adata, needle, ignore_after=OBSM_SEP, haystacks=['obs', 'obsm', 'var_names']):
+def sample_lod(adata, size, bs='umap', components=(0, 1), seed=None, max_level=LOD_MAX_LEVEL, copy=False):
     f'''
-    Search for a needle in multiple haystacks.
+    Build a multi-resolution sample of the embedding.
+
+    At each level `l` of the quadtree, the embedding is divided into `2 ** l` cells
+    in each dimension and a random cell of each of them is chosen as a representative.
+    Representatives are nested, i.e. a representative at level `l` is also one at level `l + 1`.
 
     Params
     --------
     adata: anndata.AnnData
         anndata object
-    needle: Str
-        needle to search for
-    ignore_after: Str, optional (default: `'{OBSM_SEP}'`)
-        token used for extracting the actual key name
-        from the needle of form `KeyTokenIndex`, neeeded
-        when `'obsm' in haystacks`, useful e.g. for extracting specific components
-    haystack: List[Str], optional (default: `['obs', 'obsm', 'var_names']`)
-        attributes of `anndata.AnnData`
+    size: Int
+        number of cells in the sample and the maximum number of cells per viewport query
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm`
+    components: List[Int], optional (default: `(0, 1)`)
+        components of the basis to use
+    seed: Int, optional (default: `None`)
+        random seed used for choosing the representatives
+    max_level: Int, optional (default: `{LOD_MAX_LEVEL}`)
+        maximum depth of the quadtree
+    copy: Bool, optional (default: `False`)
+        whether to return a copy of `adata` instead of `LODView`
 
     Returns
     --------
-    (result, is_categorical): Tuple[Object, Bool]
-        the found object and whether it's categorical
+    (adata, ixs): Tuple[Union[LODView, anndata.AnnData], np.ndarray]
+        the subsampled object and the sorted indices of the sampled cells
     '''
 
-    for haystack in haystacks:
-        obj = getattr(adata, haystack)
-        if ignore_after in needle and haystack == 'obsm':
-            k, ix = needle.split(ignore_after)
-            ix = int(ix)
-        else:
-            k, ix = needle, None
+    assert len(components)
+    assert min(components) >= 0
+    assert max_level >= 0, f'`max_level` must be non-negative, found `{max_level}`.'
 
-        if k in obj:
-            res = obj[k] if haystack != 'var_names' else adata.obs_vector(k)
-            if ix is not None:
-                assert res.ndim == 2, f'`adata.{haystack}[{k}]` must have a dimension of 2, found `{res.dim}`.'
-                assert res.shape[-1] > ix, f'Index `{ix}` out of bounds for `adata.{haystack}[{k}]` of shape `{res.shape}`.'
-                res = res[:, ix]
-            if res.shape != (adata.n_obs, ):
-                msg = f'`{needle}` in `adata.{haystack}` has wrong shape of `{res.shape}`.'
-                if haystack == 'obsm':
-                    msg += f' Try using `{needle}{OBSM_SEP}ix`, 0 <= `ix` < {res.shape[-1]}.'
-                raise ValueError(msg)
+    embedding = np.asarray(adata.obsm[f'X_{bs}'][:, components], dtype=np.float64)
+    n_obs, n_dim = embedding.shape
 
-            return res, is_categorical(res)
+    m, M = np.min(embedding, axis=0), np.max(embedding, axis=0)
+    span = M - m
+    span[span == 0] = 1
+    scaled = (embedding - m) / span
 
-    raise ValueError(f'Unable to find `{needle}` in `adata.{haystacks}`.')
+    # unique priorities, the representative of each cell has the highest one
+    priority = np.random.RandomState(seed).permutation(n_obs)
+    by_priority = np.argsort(-priority)
+    level = np.full(n_obs, max_level + 1, dtype=np.int64)
 
+    for l in range(max_level + 1):
+        k = 2 ** l
+        coords = np.clip(np.floor(scaled * k), 0, k - 1).astype(np.int64)
+        bins = np.ravel_multi_index(tuple(coords.T), (k, ) * n_dim)
+        _, first = np.unique(bins[by_priority], return_index=True)
+        reps = by_priority[first]
+        level[reps] = np.minimum(level[reps], l)
 
-def get_all_obsm_keys(adata, ixs):
-    if not isinstance(ixs, (tuple, list)):
-        ixs = [ixs]
+        if len(reps) == n_obs:
+            break
 
-    assert all(map(lambda ix: ix >= 0, ixs)), f'All indices must be non-negative.'
+    order = np.lexsort((-priority, level))
+    counts = np.bincount(level, minlength=max_level + 2)
+    levels, = np.where(counts > 0)
+    offsets = np.cumsum(counts)[levels]
 
-    return list(itertools.chain.from_iterable((f'{key}{OBSM_SEP}{ix}'
-                                          for key in adata.obsm.keys() if isinstance(adata.obsm[key], np.ndarray) and adata.obsm[key].ndim == 2 and adata.obsm[key].shape[-1] > ix)
-                                          for ix in ixs))
-# based on:
-# https://github.com/velocyto-team/velocyto-notebooks/blob/master/python/DentateGyrus.ipynb
-def sample_unif(adata, steps, bs='umap', components=(0, 1)):
-    if not isinstance(steps, (tuple, list)):
-        steps = [steps] * len(components)
+    # the remaining cells are indexed by the cells of the finest level
+    view = LODView(adata, order, offsets, embedding[order], size, np.minimum(levels, max_level))
 
-    assert len(components)
-    assert min(components) >= 0
+    return (view.to_adata() if copy else view), view.ixs
 
-    embedding = adata.obsm[f'X_{bs}'][:, components]
-    n_dim = len(components)
 
-    grs = []
-    for i in range(n_dim):
-        m, M = np.min(embedding[:, i]), np.max(embedding[:, i])
-        m = m - 0.025 * np.abs(M - m)
-        M = M + 0.025 * np.abs(M - m)
-        gr = np.linspace(m, M, num=steps[i])
-        grs.append(gr)
+def weighted_sample(weights, size, seed=None):
+    '''
+    Sample without replacement with probabilities proportional to the weights.
+
+    Each element gets a key `E / w`, where `E ~ Exp(1)`, and the `size`
+    elements with the smallest keys are selected (Efraimidis-Spirakis),
+    which is linear in the number of elements.
+
+    Params
+    --------
+    weights: np.ndarray
+        non-negative weights
+    size: Int
+        number of elements to sample
+    seed: Int, optional (default: `None`)
+        random seed
+
+    Returns
+    --------
+    ixs: np.ndarray
+        sorted indices of the sampled elements
+    '''
+
+    weights = np.asarray(weights, dtype=np.float64)
+    n_obs = len(weights)
+
+    assert size >= 0, f'`size` must be non-negative, found `{size}`.'
+    assert np.all(weights >= 0), 'All weights must be non-negative.'
 
-    meshes_tuple = np.meshgrid(*grs)
-    gridpoints_coordinates = np.vstack([i.flat for i in meshes_tuple]).T
+    if size >= n_obs:
+        return np.arange(n_obs, dtype=np.int64)
 
-    nn = NearestNeighbors()
-    nn.fit(embedding)
-    dist, ixs = nn.kneighbors(gridpoints_coordinates, 1)
+    state = np.random.RandomState(seed)
+    with np.errstate(divide='ignore'):
+        keys = state.standard_exponential(n_obs) / weights
+
+    ixs = np.argpartition(keys, size)[:size]
 
-    diag_step_dist = np.linalg.norm([grs[dim_i][1] - grs[dim_i][0] for dim_i in range(n_dim)])
-    min_dist = diag_step_dist / 2
+    return np.sort(ixs).astype(np.int64)
 
-    ixs = ixs[dist < min_dist]
-    ixs = np.unique(ixs)
 
-    return adata[ixs, :].copy(), ixs
+def sample_density(adata, size, bs='umap', seed=None, components=[0, 1], bandwidth=None,
+                   method='exact', cache_dir=None, copy=False):
+    '''
+    Sample cells with probabilities proportional to the exponentiated density, see `embedding_density`.
+
+    Params
+    --------
+    adata: anndata.AnnData
+        anndata object
+    size: Int
+        number of cells to sample
+    bs: Str, optional (default: `'umap'`)
+        basis in `adata.obsm`
+    seed: Int, optional (default: `None`)
+        random seed
+    components: List[Int], optional (default: `[0, 1]`)
+        components of the basis to use
+    bandwidth: Float, optional (default: `None`)
+        bandwidth factor of the gaussian kernel, see `embedding_density`
+    method: Str, optional (default: `'exact'`)
+        how to estimate the density, `'exact'` uses the gaussian KDE,
+        `'binned'` is a much faster approximation for large data, see `embedding_density`
+    cache_dir: Union[os.PathLike, Str, Bool, NoneType], optional (default: `None`)
+        directory where to persist the densities and reproducible samples, see `get_cache_dir`
+    copy: Bool, optional (default: `False`)
+        whether to return a copy of `adata` instead of `SampledView`
 
+    Returns
+    --------
+    (adata, ixs): Tuple[Union[SampledView, anndata.AnnData], np.ndarray]
+        the subsampled object and the sorted indices of the sampled cells
+    '''
 
-def sample_density(adata, size, bs='umap', seed=None, components=[0, 1]):
     if size >= adata.n_obs:
-        return adata
+        return _sampled(adata, None, copy=copy), np.arange(adata.n_obs)
+
+    # only reproducible samples are persisted
+    sample_dir = get_cache_dir(adata, cache_dir) if seed is not None else None
+    path = None if sample_dir is None else \
+        _cache_file(sample_dir, 'density_sample', adata.obsm[f'X_{bs}'][:, components],
+                    size=size, seed=seed, bandwidth=bandwidth, method=method)
+
+    ixs = _load_cached(path, 'ixs')
+    if ixs is not None:
+        return _sampled(adata, ixs, copy=copy), ixs
 
     if components[0] == components[1]:
-        tmp = pd.DataFrame(np.ones(adata.n_obs) / adata.n_obs, columns=['prob_density'])
+        prob_density = np.ones(adata.n_obs) / adata.n_obs
     else:
-        # should be unique, using it only once since we cache the results
-        # we don't need to add the components
-        key_added =  f'{bs}_density_ipl_tmp'
-        remove_key = False  # we may be operating on original object, keep it clean
-        if key_added not in adata.obs.keys():
-            sc.tl.embedding_density(adata, bs, key_added=key_added)
-            remove_key = True
-        tmp = pd.DataFrame(np.exp(adata.obs[key_added]) / np.sum(np.exp(adata.obs[key_added])))
-        tmp.rename(columns={key_added: 'prob_density'}, inplace=True)
-        if remove_key:
-            del adata.obs[key_added]
+        density = np.exp(embedding_density(adata, bs, components=components, bandwidth=bandwidth,
+                                           method=method, cache_dir=cache_dir))
+        prob_density = density / np.sum(density)
 
-    state = np.random.RandomState(seed)
-    ixs = sorted(state.choice(range(adata.n_obs), size=size, p=tmp['prob_density'], replace=False))
+    ixs = weighted_sample(prob_density, size, seed=seed)
+    _save_cached(path, ixs=ixs)
 
-    return adata[ixs].copy(), ixs
+    return _sampled(adata, ixs, copy=copy), ixs
 
 
 def get_xy_data(x, adata, adata_mraw, layer, indices, use_original_limits=False, inc=0):
@@ -545,12 +3373,15 @@ def get_xy_data(x, adata, adata_mraw, layer, indices, use_original_limits=False,
     def extract(data, ix):
         if isinstance(data, anndata._core.anndata.Raw) or \
             isinstance(data, anndata.AnnData):
-            return data.obs_vector(ix)[indices]
-        if issparse(data):
-            return np.squeeze(data.getcol(ix).A)[indices]
+            accessor = expression_accessor(data)
+            if accessor is None:
+                return data.obs_vector(data.var_names[ix])[indices]
+        else:
+            accessor = expression_accessor(adata, layer)
+            if accessor is None:
+                return np.squeeze(data[:, ix])[indices]
 
-        # assume np.array
-        return data[indices, ix]
+        return accessor[ix][indices]
 
     xlim = None
     msg = f'Unable to decode key `{x}`.'
@@ -566,15 +3397,16 @@ def get_xy_data(x, adata, adata_mraw, layer, indices, use_original_limits=False,
     if not isinstance(x, int):
         assert isinstance(x, str)
         # can't use take from, since it can be an array
-        if x in adata_mraw.var_names:
-            ix = np.where(x == adata_mraw.var_names)[0][0]
-            xlabel = adata_mraw.var_names[ix]
-            x = extract(take_from, ix)
+        index = key_index(adata)
+        info = index.resolve(x, where=('var_names', ), raw=adata_mraw is not adata)
+        if info is not None:
+            xlabel = info.key
+            x = extract(take_from, info.ix)
 
             return x, xlabel, xlim
 
-        if x in adata_mraw.obs_keys():
-            x, xlabel = adata_mraw.obs[x].values, x
+        if index.resolve(x, where=('obs', )) is not None:
+            x, xlabel = adata.obs[x].values, x
             if use_original_limits:
                 xlim = pad(*minmax(x))
 